@@ -1,26 +1,164 @@
 import pandas as pd
 from pathlib import Path
 import json
-from functools import partial
+import re
+import sys
+import threading
+from collections import Counter
+from itertools import combinations
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
-from agnostic_evaluator_models import API_text_to_text, openai_init, openai_call, anthropic_init, anthropic_call, meta_init, meta_call, lab_key
+sys.path.append(str(Path(__file__).resolve().parents[1] / "common"))
+from response_cache import ResponseCache, backend_name, backend_params
+from backends import get_backend
+from rate_limiter import get_rate_limiter
+from resilience import resilient_pair
+from telemetry import telemetry_context, telemetry_queued
+from summary_index import open_summary_index
+from fact_prescreen import FactPrescreen, calibration_report
+from run_store import plain_key
 
-gpt4o = partial(openai_init, "gpt-4o", lab_key)
-claude = partial(anthropic_init, "claude-3-5-sonnet-v2", lab_key)
-llama = partial(meta_init, "llama-3-3-70B-instruct", lab_key)
-my_llms = [(gpt4o, openai_call), (claude, anthropic_call), (llama, meta_call)]
+# Judges by backend name (see backends.py), their SDKs are only imported when an AutoEval is created with them
+my_llms = ["gpt-4o", "claude-3-5-sonnet-v2", "llama-3-3-70B-instruct"]
 
+# Strings (with their escapes) or brackets, used to find where a JSON value starts and ends in one pass
+json_token = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\]]', re.S)
+# Field values of a malformed object. A string ends at the first quote followed by the next field or the end of the
+# object, so that unescaped quotes inside an explanation are kept
+json_field = {key: re.compile(rf'"{key}"\s*:\s*(?:"((?:[^\\]|\\.)*?)"(?=\s*(?:,\s*"\w+"\s*:|,?\s*[}}\]]|,?\s*$))|(-?\d+(?:\.\d+)?))', re.S)
+              for key in ("fact_id", "explanation", "fact_mentioned", "score")}
+judge_values = {"fact_mentioned": (0, 1), "score": tuple(range(1, 11))}
+
+# Outcome of every distinct judge output parsed: "parsed" (valid JSON), "repaired" (fields recovered), "failed"
+json_parse_stats = {"parsed": 0, "repaired": 0, "failed": 0}
+json_parse_stats_lock = threading.Lock()
+
+def find_outermost(text, open_char="{"):
+    # Outermost {...} or [...] of the text, brackets inside strings are ignored. A truncated value runs to the end
+    close_char = "}" if open_char == "{" else "]"
+    start = text.find(open_char)
+    if start == -1:
+        return None
+    depth = 0
+    for match in json_token.finditer(text, start):
+        token = match.group()
+        if token == open_char:
+            depth += 1
+        elif token == close_char:
+            depth -= 1
+            if depth == 0:
+                return text[start:match.end()]
+    return text[start:]
+
+def loads_or_none(text):
+    if text is None:
+        return None
+    try:
+        # strict=False accepts raw newlines inside the explanation
+        return json.loads(text, strict=False)
+    except ValueError:
+        return None
+
+def extract_fields(text):
+    # Recover the known fields of a malformed object (missing commas, trailing commas, // comments, ...)
+    fields = {}
+    for key, pattern in json_field.items():
+        match = pattern.search(text)
+        if match is None:
+            continue
+        if match.group(1) is not None:
+            # Quotes left unescaped inside the value are escaped before decoding it
+            value = loads_or_none('"' + re.sub(r'(?<!\\)"', r'\\"', match.group(1)) + '"')
+            fields[key] = value if value is not None else match.group(1)
+        else:
+            fields[key] = float(match.group(2))
+    return fields
+
+def validate_judge_fields(parsed):
+    # Keep explanation as is, drop fact_mentioned / score values outside of their allowed range
+    valid = {}
+    for key, value in parsed.items():
+        if key in judge_values:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+            if value not in judge_values[key]:
+                continue
+        valid[key] = value
+    return valid
+
+def count_parse(outcome):
+    with json_parse_stats_lock:
+        json_parse_stats[outcome] += 1
+
+def split_objects(text):
+    # Top-level {...} of a text (e.g. the items of a malformed array), brackets inside strings are ignored.
+    # A truncated last object runs to the end
+    objects = []
+    depth = 0
+    start = None
+    for match in json_token.finditer(text):
+        token = match.group()
+        if token == "{":
+            if depth == 0:
+                start = match.start()
+            depth += 1
+        elif token == "}" and depth > 0:
+            depth -= 1
+            if depth == 0:
+                objects.append(text[start:match.end()])
+    if depth > 0:
+        objects.append(text[start:])
+    return objects
+
+def parse_judge_object(text):
+    # (valid judge fields of one {...}, "parsed" or "repaired")
+    parsed = loads_or_none(text)
+    if isinstance(parsed, dict):
+        return validate_judge_fields(parsed), "parsed"
+    return validate_judge_fields(extract_fields(text)), "repaired"
+
+@lru_cache(maxsize=8192)
 def llm_output_to_json(llm_output):
-    reformated_response =  llm_output.replace("\n", " ").replace("*", " ").replace("-", " ").replace("```", "").replace("json", "")
-    reformated_response = reformated_response[:-10] + reformated_response[-10:].replace(",", "")
-    for _ in range(5):
-        try:
-            json.loads(reformated_response)
-        except Exception as e:
-            e = str(e)
-            coma_pos = int(e[e.find("char ")+5:].replace(")", ""))
-            reformated_response = reformated_response[:coma_pos] + "," + reformated_response[coma_pos:]
-    return json.loads(reformated_response)
+    # Parse a judge output once; the returned dict is shared between callers and must not be modified.
+    # The first top-level {...} holding a judge field is used: braces in a preamble ("Sure {here} is: {...}") are skipped
+    first = None
+    for candidate in split_objects(llm_output) or [llm_output]:
+        parsed, outcome = parse_judge_object(candidate)
+        if any(key in parsed for key in judge_values):
+            count_parse(outcome)
+            return parsed
+        first = first if first is not None else parsed
+    count_parse("failed")
+    return first
+
+@lru_cache(maxsize=8192)
+def llm_output_to_json_list(llm_output):
+    # Objects of the outermost JSON array of a batched judge output. When the array is malformed, each of its objects
+    # is parsed on its own, with the field recovery of llm_output_to_json: one broken object does not lose the others
+    candidate = find_outermost(llm_output, "[")
+    parsed = loads_or_none(candidate)
+    if isinstance(parsed, list):
+        count_parse("parsed")
+        return [validate_judge_fields(item) for item in parsed if isinstance(item, dict)]
+    items = []
+    for text in split_objects(candidate if candidate is not None else llm_output):
+        items.append(parse_judge_object(text)[0])
+    items = [item for item in items if any(key in item for key in judge_values)]
+    count_parse("repaired" if items else "failed")
+    return items
+
+class FailedCall:
+    # Output of a judge call that raised: its row gets NaN and the error as explanation, the other rows are kept
+    def __init__(self, error):
+        self.error = repr(error)
+
+def parse_judge_output(llm_output):
+    if isinstance(llm_output, FailedCall):
+        return {"explanation": f"Judge call failed: {llm_output.error}"}
+    return llm_output_to_json(llm_output)
 
 def make_fact_eval_prompt(proto_ds, fact):
     prompt = f"""You are an expert AI assistant specializing in internal medicine. Your task is to analyze a provided hospital course summary and determine whether a specific, important fact is explicitly mentioned.
@@ -60,6 +198,39 @@ def make_fact_eval_prompt(proto_ds, fact):
     {proto_ds}"""
     return prompt
 
+def make_multi_fact_eval_prompt(proto_ds, facts):
+    facts_txt = "\n    ".join(f"Fact {fact_id}: {fact}" for fact_id, fact in enumerate(facts))
+    prompt = f"""You are an expert AI assistant specializing in internal medicine. Your task is to analyze a provided hospital course summary and determine, for each of the important facts listed below, whether it is explicitly mentioned.
+    Output your response as a valid JSON array with one object per fact, in the following format:
+
+    ```json
+    [
+        {{
+            "fact_id": integer,  // the number of the fact as listed below
+            "explanation": "Detailed, step-by-step reasoning process explaining why the fact is or is not present in the hospital course summary.",
+            "fact_mentioned": integer  // 1 if the fact is explicitly mentioned, 0 if not.
+        }}
+    ]
+
+    Guidelines:
+    1. Independence: Judge each fact on its own. The answer for one fact must not influence the answer for another.
+    2. Reasoning: Provide a clear and concise explanation of your thought process in the "explanation" field. Break down your analysis into logical steps, showing how you searched for the information and what led you to your conclusion. Explain why you believe the fact is or is not mentioned.
+    3. Fact Determination: The "fact_mentioned" field must be either 1 or 0.
+        - Use 1 only if the important fact is explicitly and unambiguously stated in the hospital course summary.
+        - Use 0 if the fact is not explicitly mentioned, even if it could be inferred or is likely to be true based on other information. Ambiguity implies the fact is not explicitly mentioned.
+    4. JSON Format:
+        Adhere strictly to the JSON format provided. Do not include any surrounding text or markdown.
+        The entire response must be a single, valid JSON array enclosed in square brackets, containing exactly one object per fact.
+        Ensure proper key-value pairing and use of quotation marks.
+    5. No Extraneous Output: Output only the JSON array. Do not include any introductory or concluding sentences, greetings, or other text outside the JSON.
+
+    --- Important Facts to look for ---
+    {facts_txt}
+
+    --- Hospital Course Summary ---
+    {proto_ds}"""
+    return prompt
+
 def make_llm_as_judge_prompt(proto_ds):
     prompt = f"""You are an AI assistant, acting as a senior internal medicine physician evaluating the quality of a hospital course summary. Your task is to analyze the provided summary and assign it a quality score from 1 to 10, where 10 represents the highest possible quality.
     Your response MUST be formatted as valid JSON according to the following schema:
@@ -94,12 +265,39 @@ def make_llm_as_judge_prompt(proto_ds):
     {proto_ds}"""
     return prompt
 
+# Per-patient results of each evaluation method, checkpointed by AutoEval.run_checkpointed
+eval_result_attrs = {"fact_eval": ("fact_eval_res", "fact_eval_expl", "fact_eval_votes", "fact_eval_prescreen"),
+                     "unconditional_eval": ("unc_eval_res", "unc_eval_expl", "unc_eval_votes")}
+
+class DirectTextToText:
+    # Stand-in for API_text_to_text when agnostic_evaluator_models is not installed (e.g. mock_llm judges offline):
+    # the (model_init, model_call) pair is called directly
+    def __init__(self, model_init, model_call):
+        self.model_call = model_call
+        self.init_dict = model_init()
+
+    def gen_txt_to_txt(self, input_txt):
+        return self.model_call(input_txt, **self.init_dict)
+
+def text_to_text_adapter():
+    try:
+        from agnostic_evaluator_models import API_text_to_text
+    except ImportError:
+        return DirectTextToText
+    return API_text_to_text
+
 class AutoEval:
-    def __init__(self, llm_eval_pair, proto_model="gpt-4o"):
-        self.llm_eval_pair = llm_eval_pair
+    def __init__(self, llm_eval_pair, proto_model="gpt-4o", cache=None, max_workers=8, requests_per_minute=None, test_path=None, fact_df_path=None, telemetry=None, prescreen=None):
+        self.cache = cache
+        self.telemetry = telemetry
+        # Judge calls run on a pool of max_workers threads, optionally throttled per provider
+        self.max_workers = max_workers
+        self.judge = self._make_judge(llm_eval_pair, requests_per_minute)
+        self.provider, self.llm_eval_pair, self.rate_limiter = self.judge
+        self.judges = [self.judge]
         self.proto_model = proto_model
-        self.test_path = Path("../prototyping/generated_dc_sum/testset")
-        self.fact_df_path = Path("../../exports/fact_data/benchmark_creation - all_responses.csv")
+        self.test_path = Path(test_path if test_path is not None else "../prototyping/generated_dc_sum/testset")
+        self.fact_df_path = Path(fact_df_path if fact_df_path is not None else "../../exports/fact_data/benchmark_creation - all_responses.csv")
 
         # Read the facts
         fact_df = pd.read_csv(self.fact_df_path)
@@ -107,50 +305,366 @@ class AutoEval:
         self.facts = fact_df.iloc[:,[3,5,7]].copy()
         self.facts.loc[:,'patient_i'] = fact_df.iloc[:,0].apply(lambda x: int(''.join(filter(str.isdigit, str(x))))) - 1 
         
-        # Read the proto summaries
-        proto_files = list(self.test_path.rglob(f"**/{proto_model}.md"))
-        self.proto_summaries = []
-        for file_path in proto_files:
-            patient_i = [p for p in file_path.parts if "patient_" in p][0]
-            patient_n = int(''.join(filter(str.isdigit, patient_i))) 
-            with open(file_path, 'r', encoding='utf-8') as f:
-                self.proto_summaries.append((patient_n, f.read().split("\n\n", 1)[1]))
-        self.proto_summaries = pd.DataFrame(self.proto_summaries, columns=['patient_i', 'summary'])
+        # Read the proto summaries from the manifest of test_path, shared by every AutoEval of the process
+        self.summary_index = open_summary_index(self.test_path)
+        self.proto_summaries = self.summary_index.summaries(proto_model)
         # Include only the proto summaries of patients that are in the fact_df
         self.proto_facts_merged = pd.merge(self.proto_summaries, self.facts, left_on='patient_i', right_on='patient_i', how='right')
+        # Evaluate a subset of the patients only (see run_checkpointed)
+        self.only_patients = None
+        # Optional FactPrescreen: facts found almost verbatim in the summary are resolved without a judge call
+        self.prescreen = prescreen
+        # Judge calls of the last evaluation that raised, and their patients (not checkpointed by run_checkpointed)
+        self.failed_calls = 0
+        self.failed_patients = set()
         
-    def fact_eval(self):
-        llm_instance = API_text_to_text(*self.llm_eval_pair)
-        self.fact_eval_res = {}
-        self.fact_eval_expl = {}
+    def _make_judge(self, llm_eval_pair, requests_per_minute=None):
+        # (provider, llm_eval_pair, rate_limiter) of one judge model, given as a (model_init, model_call) pair or a backend name
+        eval_init, eval_call = get_backend(llm_eval_pair) if isinstance(llm_eval_pair, str) else llm_eval_pair
+        provider = backend_name(eval_init)
+        # Optional ResponseCache: judge calls with an unchanged prompt and model are read from disk
+        if self.cache is not None:
+            eval_call = self.cache.wrap(eval_call, provider, **backend_params(eval_init))
+        # Optional Telemetry: one event per judge call with its stage, patient, fact, sizes and latency
+        if self.telemetry is not None:
+            eval_call = self.telemetry.wrap(eval_call, provider)
+        rate_limiter = get_rate_limiter(provider, requests_per_minute) if requests_per_minute else None
+        return provider, (eval_init, eval_call), rate_limiter
+
+    def _patients(self):
+        # (patient id, proto summary, its three facts) of every patient with facts, or of self.only_patients
         for patient_i in range(len(self.proto_facts_merged)):
             id = self.proto_facts_merged["patient_i"][patient_i]
-            self.fact_eval_res[f'patient_{id}'] = {}
-            self.fact_eval_expl[f'patient_{id}'] = {}
-            for fact_j in range(3):
-                proto_summary = self.proto_facts_merged.iloc[patient_i, 1]
-                fact = self.proto_facts_merged.iloc[patient_i,2+fact_j]
-                fact_eval_prompt = make_fact_eval_prompt(proto_summary, fact)
-                llm_output = llm_instance.gen_txt_to_txt(fact_eval_prompt)
-                self.fact_eval_res[f'patient_{id}'][f'fact_{fact_j}'] = float(llm_output_to_json(llm_output).get("fact_mentioned", float('nan')))
-                self.fact_eval_expl[f'patient_{id}'][f'fact_{fact_j}'] = llm_output_to_json(llm_output).get("explanation", float('nan'))
+            if self.only_patients is not None and id not in self.only_patients:
+                continue
+            proto_summary = self.proto_facts_merged.iloc[patient_i, 1]
+            facts = [self.proto_facts_merged.iloc[patient_i,2+fact_j] for fact_j in range(3)]
+            yield id, proto_summary, facts
+
+    def _prescreen(self, id, proto_summary, facts):
+        # Record the facts of a patient resolved locally by self.prescreen, returns the positions of the others
+        for results in (self.fact_eval_res, self.fact_eval_expl, self.fact_eval_prescreen):
+            results.setdefault(f'patient_{id}', {})
+        if self.prescreen is None:
+            return list(range(len(facts)))
+        remaining = []
+        for fact_j, fact in enumerate(facts):
+            confidence, value, explanation = self.prescreen.decide(proto_summary, fact)
+            self.fact_eval_prescreen[f'patient_{id}'][f'fact_{fact_j}'] = confidence
+            if value is None:
+                remaining.append(fact_j)
+            else:
+                self.fact_eval_res[f'patient_{id}'][f'fact_{fact_j}'], self.fact_eval_expl[f'patient_{id}'][f'fact_{fact_j}'] = value, explanation
+        return remaining
+
+    def _run_jobs(self, jobs):
+        # jobs: (judge, prompt, telemetry attributes such as stage, patient, fact), all sent concurrently.
+        # Outputs are returned in the order of the jobs, a FailedCall for each call that raised
+        API_text_to_text = text_to_text_adapter()
+        llm_instances = {}
+        for (provider, llm_eval_pair, _), _, _ in jobs:
+            if provider not in llm_instances:
+                llm_instances[provider] = API_text_to_text(*llm_eval_pair)
+        def run(job):
+            (provider, _, rate_limiter), prompt, context = job
+            with telemetry_context(**context):
+                with telemetry_queued():
+                    if rate_limiter is not None:
+                        rate_limiter.acquire()
+                return llm_instances[provider].gen_txt_to_txt(prompt)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(run, job) for job in jobs]
+            wait(futures)
+        outputs = []
+        for (_, _, context), future in zip(jobs, futures):
+            if future.exception() is None:
+                outputs.append(future.result())
+                continue
+            outputs.append(FailedCall(future.exception()))
+            self.failed_calls += 1
+            if "patient" in context:
+                self.failed_patients.add(context["patient"])
+        failed = [output for output in outputs if isinstance(output, FailedCall)]
+        if failed:
+            print(f"""{len(failed)} of {len(jobs)} judge calls failed, first error: {failed[0].error}""")
+        return outputs
+
+    def _run_prompts(self, prompts, contexts=None):
+        # Send every prompt to the judge concurrently, outputs are returned in the order of the prompts
+        contexts = contexts if contexts is not None else [{}] * len(prompts)
+        return self._run_jobs([(self.judge, prompt, context) for prompt, context in zip(prompts, contexts)])
+
+    def run_checkpointed(self, method, run_store, checkpoint_every=64, **kwargs):
+        # Run an evaluation method ("fact_eval" or "unconditional_eval") chunk by chunk of checkpoint_every patients,
+        # the results of each patient being appended to run_store (one kind of record per method, model and judges).
+        # Patients already in the store are not evaluated again, patients with a failed judge call are not stored and
+        # evaluated again by the next run. The result dicts then hold every patient, counters such as fact_eval_calls only the last chunk
+        kind = f"{method}:{self.proto_model}:{'+'.join(provider for provider, _, _ in self.judges)}"
+        if kwargs.get("batched"):
+            kind += ":batched"
+        if method == "fact_eval" and self.prescreen is not None:
+            kind += f":prescreen{self.prescreen.accept_above}/{self.prescreen.reject_below}"
+        attrs = eval_result_attrs[method]
+        ids = [plain_key(id) for id in self.proto_facts_merged["patient_i"]]
+        todo = [id for id in ids if not run_store.is_done(kind, id)]
+        try:
+            for chunk_start in range(0, len(todo), checkpoint_every):
+                self.only_patients = set(todo[chunk_start:chunk_start + checkpoint_every])
+                getattr(self, method)(**kwargs)
+                for id in self.only_patients - {plain_key(failed) for failed in self.failed_patients}:
+                    run_store.append(kind, id, {attr: getattr(self, attr)[f'patient_{id}'] for attr in attrs if hasattr(self, attr)})
+        finally:
+            self.only_patients = None
+        records = {id: run_store.get(kind, id) for id in ids if run_store.get(kind, id) is not None}
+        for attr in attrs:
+            if any(attr in record for record in records.values()):
+                setattr(self, attr, {f'patient_{id}': record.get(attr) for id, record in records.items()})
+
+    def fact_eval(self, batched=False):
+        # batched=True judges the three facts of a patient in a single call, facts missing from the answer are re-judged one by one.
+        # With a prescreen, only the facts it leaves unresolved are sent (fact_eval_prescreen holds its confidences)
+        self.fact_eval_res = {}
+        self.fact_eval_expl = {}
+        self.fact_eval_prescreen = {}
+        self.failed_calls, self.failed_patients = 0, set()
+        jobs = list(self._patients())
+        remaining = {id: self._prescreen(id, proto_summary, facts) for id, proto_summary, facts in jobs}
+        self.fact_eval_prescreened = sum(len(facts) - len(remaining[id]) for id, _, facts in jobs)
+        llm_outputs = {}
+        if batched:
+            batch_jobs = [(id, proto_summary, facts) for id, proto_summary, facts in jobs if remaining[id]]
+            outputs = self._run_prompts([make_multi_fact_eval_prompt(proto_summary, [facts[fact_j] for fact_j in remaining[id]]) for id, proto_summary, facts in batch_jobs],
+                                        [{"stage": "fact_eval_batched", "patient": id} for id, _, _ in batch_jobs])
+            llm_outputs = {id: llm_output for (id, _, _), llm_output in zip(batch_jobs, outputs)}
+        self.fact_eval_calls = len(llm_outputs)
+        
+        # Collect the batched answers and list the (patient, fact) pairs still to be judged on their own
+        single_jobs = []
+        for id, proto_summary, facts in jobs:
+            # fact_id of the batched prompt -> position of the fact among the patient's facts
+            fact_positions = dict(enumerate(remaining[id]))
+            answers = {}
+            batched_output = llm_outputs.get(id)
+            for item in llm_output_to_json_list(batched_output) if isinstance(batched_output, str) else []:
+                try:
+                    answers[fact_positions[int(item["fact_id"])]] = (float(item["fact_mentioned"]), item.get("explanation", float('nan')))
+                except (KeyError, TypeError, ValueError):
+                    continue
+            for fact_j in remaining[id]:
+                if fact_j in answers:
+                    self.fact_eval_res[f'patient_{id}'][f'fact_{fact_j}'], self.fact_eval_expl[f'patient_{id}'][f'fact_{fact_j}'] = answers[fact_j]
+                else:
+                    single_jobs.append((id, fact_j, make_fact_eval_prompt(proto_summary, facts[fact_j])))
+        self.fact_eval_fallbacks = len(single_jobs) if batched else 0
+        
+        llm_outputs = self._run_prompts([prompt for _, _, prompt in single_jobs],
+                                        [{"stage": "fact_eval", "patient": id, "fact": fact_j} for id, fact_j, _ in single_jobs])
+        self.fact_eval_calls += len(single_jobs)
+        for (id, fact_j, _), llm_output in zip(single_jobs, llm_outputs):
+            judge_json = parse_judge_output(llm_output)
+            self.fact_eval_res[f'patient_{id}'][f'fact_{fact_j}'] = float(judge_json.get("fact_mentioned", float('nan')))
+            self.fact_eval_expl[f'patient_{id}'][f'fact_{fact_j}'] = judge_json.get("explanation", float('nan'))
+
+    def compare_fact_eval_modes(self):
+        # Run the single-fact and batched modes and report how often they agree (use a cache to avoid paying twice).
+        # Facts without an answer (NaN) in either mode are counted apart, not as disagreements
+        self.fact_eval(batched=False)
+        single_res, single_calls = self.fact_eval_res, self.fact_eval_calls
+        self.fact_eval(batched=True)
+        pairs = [(single_res[patient][fact], res) for patient, facts in self.fact_eval_res.items() for fact, res in facts.items()]
+        answered = [(single, batched) for single, batched in pairs if single == single and batched == batched]
+        agreements = [single == batched for single, batched in answered]
+        self.fact_eval_agreement = {"n_facts": len(pairs),
+                                    "n_compared": len(answered),
+                                    "agreement": sum(agreements) / len(agreements) if agreements else float('nan'),
+                                    "disagreements": len(agreements) - sum(agreements),
+                                    "unanswered_single": sum(single != single for single, _ in pairs),
+                                    "unanswered_batched": sum(batched != batched for _, batched in pairs),
+                                    "unanswered_both": sum(single != single and batched != batched for single, batched in pairs),
+                                    "single_calls": single_calls,
+                                    "batched_calls": self.fact_eval_calls,
+                                    "batched_fallbacks": self.fact_eval_fallbacks}
+        return self.fact_eval_agreement
+
+    def calibrate_prescreen(self, prescreen=None, thresholds=(0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.0)):
+        # Judge every fact with the prescreen off (use a cache to avoid paying twice) and compare its local decisions with
+        # the judge's answers: calls saved and agreement at the thresholds of prescreen (self.prescreen by default),
+        # and per threshold in prescreen_calibration_table to choose them
+        prescreen = prescreen if prescreen is not None else self.prescreen if self.prescreen is not None else FactPrescreen()
+        active_prescreen, self.prescreen = self.prescreen, None
+        try:
+            self.fact_eval()
+        finally:
+            self.prescreen = active_prescreen
+        confidences = []
+        judged = []
+        for id, proto_summary, facts in self._patients():
+            for fact_j, fact in enumerate(facts):
+                confidences.append(prescreen.score(proto_summary, fact)[0])
+                judged.append(self.fact_eval_res[f'patient_{id}'][f'fact_{fact_j}'])
+        self.prescreen_calibration, self.prescreen_calibration_table = calibration_report(confidences, judged, prescreen, thresholds)
+        return self.prescreen_calibration
                 
     def unconditional_eval(self):
-        llm_instance = API_text_to_text(*self.llm_eval_pair)
         self.unc_eval_res = {}
         self.unc_eval_expl = {}
-        for patient_i in range(len(self.proto_facts_merged)):
-            id = self.proto_facts_merged["patient_i"][patient_i]
+        self.failed_calls, self.failed_patients = 0, set()
+        jobs = []
+        for id, proto_summary, _ in self._patients():
             self.unc_eval_res[f'patient_{id}'] = {}
             self.unc_eval_expl[f'patient_{id}'] = {}
-            proto_summary = self.proto_facts_merged.iloc[patient_i, 1]
-            unconditional_eval_prompt = make_llm_as_judge_prompt(proto_summary)
-            llm_output = llm_instance.gen_txt_to_txt(unconditional_eval_prompt)
-            self.unc_eval_res[f'patient_{id}'] = float(llm_output_to_json(llm_output).get("score", float('nan')))
-            self.unc_eval_expl[f'patient_{id}'] = llm_output_to_json(llm_output).get("explanation", float('nan'))
+            jobs.append((id, make_llm_as_judge_prompt(proto_summary)))
+        llm_outputs = self._run_prompts([prompt for _, prompt in jobs], [{"stage": "unconditional_eval", "patient": id} for id, _ in jobs])
+        for (id, _), llm_output in zip(jobs, llm_outputs):
+            judge_json = parse_judge_output(llm_output)
+            self.unc_eval_res[f'patient_{id}'] = float(judge_json.get("score", float('nan')))
+            self.unc_eval_expl[f'patient_{id}'] = judge_json.get("explanation", float('nan'))
+
+def cohen_kappa(a, b):
+    # Agreement of two judges on binary answers, corrected for chance
+    observed = (a == b).mean()
+    expected = a.mean() * b.mean() + (1 - a.mean()) * (1 - b.mean())
+    return (observed - expected) / (1 - expected) if expected < 1 else float('nan')
+
+def fleiss_kappa(votes):
+    # votes: items x judges table of binary answers, all judges having answered every item
+    if len(votes) == 0 or votes.shape[1] < 2:
+        return float('nan')
+    n_judges = votes.shape[1]
+    ones = votes.sum(axis=1)
+    counts = pd.concat([n_judges - ones, ones], axis=1)
+    per_item = ((counts ** 2).sum(axis=1) - n_judges) / (n_judges * (n_judges - 1))
+    expected = ((counts.sum() / (len(votes) * n_judges)) ** 2).sum()
+    return (per_item.mean() - expected) / (1 - expected) if expected < 1 else float('nan')
+
+class AutoEvalEnsemble(AutoEval):
+    # Every judge of llm_eval_pairs answers each single-fact / llm-as-judge prompt, all calls running concurrently.
+    # aggregate="vote": majority for fact_mentioned (ties give 0.5) and median for scores, "mean": mean of the answers.
+    # quorum=k asks the first k judges, then the others only for the items where these k answers disagree
+    # (scores agree when they are within score_tolerance)
+    def __init__(self, llm_eval_pairs=my_llms, proto_model="gpt-4o", aggregate="vote", quorum=None, score_tolerance=0, requests_per_minute=None, **kwargs):
+        if aggregate not in ("vote", "mean"):
+            raise ValueError(f"Unknown aggregate {aggregate!r}, expected 'vote' or 'mean'")
+        if quorum is not None and not 1 <= quorum <= len(llm_eval_pairs):
+            raise ValueError(f"quorum must be between 1 and the number of judges ({len(llm_eval_pairs)})")
+        super().__init__(llm_eval_pairs[0], proto_model, requests_per_minute=requests_per_minute, **kwargs)
+        self.judges = [self.judge] + [self._make_judge(pair, requests_per_minute) for pair in llm_eval_pairs[1:]]
+        self.judge_names = [provider for provider, _, _ in self.judges]
+        if len(set(self.judge_names)) != len(self.judge_names):
+            raise ValueError(f"Judges must have distinct names, got {self.judge_names}")
+        self.aggregate = aggregate
+        self.quorum = quorum
+        self.score_tolerance = score_tolerance
+
+    def _agree(self, values, key):
+        if any(value != value for value in values):
+            return False
+        if key == "fact_mentioned":
+            return len(set(values)) == 1
+        return max(values) - min(values) <= self.score_tolerance
+
+    def _ask_judges(self, prompts, contexts, key):
+        # {judge: (value of key, explanation)} for each prompt, judges skipped thanks to the quorum are missing
+        votes = [{} for _ in prompts]
+        first_wave = self.judges[:self.quorum] if self.quorum is not None else self.judges
+        pending = range(len(prompts))
+        calls = 0
+        for wave in (first_wave, self.judges[len(first_wave):]):
+            jobs = [(i, judge) for i in pending for judge in wave]
+            outputs = self._run_jobs([(judge, prompts[i], {**contexts[i], "judge": judge[0]}) for i, judge in jobs])
+            for (i, (provider, _, _)), llm_output in zip(jobs, outputs):
+                judge_json = parse_judge_output(llm_output)
+                votes[i][provider] = (float(judge_json.get(key, float('nan'))), judge_json.get("explanation", float('nan')))
+            calls += len(jobs)
+            pending = [i for i in pending if not self._agree([value for value, _ in votes[i].values()], key)]
+        return votes, calls
+
+    def _aggregate(self, values, key):
+        values = [value for value in values if value == value]
+        if not values:
+            return float('nan')
+        if self.aggregate == "mean":
+            return sum(values) / len(values)
+        if key == "fact_mentioned":
+            ranked = Counter(values).most_common()
+            if len(ranked) > 1 and ranked[0][1] == ranked[1][1]:
+                return sum(values) / len(values)
+            return ranked[0][0]
+        return float(pd.Series(values).median())
+
+    def _agreement(self, votes, calls, key):
+        # Inter-judge agreement: per pair of judges (on the items both answered) and over all judges
+        table = pd.DataFrame([{provider: value for provider, (value, _) in item.items()} for item in votes], columns=self.judge_names)
+        report = {"items": len(table), "calls": calls, "calls_saved": len(table) * len(self.judges) - calls}
+        answered = table.notna().sum(axis=1)
+        report["unanimous"] = float((table.nunique(axis=1) == 1)[answered > 0].mean()) if len(table) else float('nan')
+        pairs = {}
+        for a, b in combinations(self.judge_names, 2):
+            both = table[[a, b]].dropna()
+            if key == "fact_mentioned":
+                pairs[f"{a} / {b}"] = {"n": len(both), "agreement": float((both[a] == both[b]).mean()), "cohen_kappa": float(cohen_kappa(both[a], both[b]))}
+            else:
+                # Spearman correlation as the Pearson correlation of the ranks (pandas needs scipy for method="spearman")
+                pairs[f"{a} / {b}"] = {"n": len(both), "mean_abs_diff": float((both[a] - both[b]).abs().mean()), "spearman": float(both[a].rank().corr(both[b].rank()))}
+        report["pairs"] = pairs
+        if key == "fact_mentioned":
+            # With a quorum only the items where the first judges disagreed have every answer: fleiss_kappa is then biased low
+            report["fleiss_kappa"] = float(fleiss_kappa(table.dropna()))
+        return report
+
+    def fact_eval(self, batched=False):
+        # fact_eval_res holds the aggregated answers, fact_eval_votes / fact_eval_expl the answer / explanation of each judge
+        if batched:
+            raise ValueError("The ensemble judges facts one by one, batched=True is not supported")
+        self.fact_eval_res = {}
+        self.fact_eval_expl = {}
+        self.fact_eval_votes = {}
+        self.fact_eval_prescreen = {}
+        self.failed_calls, self.failed_patients = 0, set()
+        jobs = []
+        for id, proto_summary, facts in self._patients():
+            remaining = self._prescreen(id, proto_summary, facts)
+            self.fact_eval_votes[f'patient_{id}'] = {f'fact_{fact_j}': {"prescreen": self.fact_eval_res[f'patient_{id}'][f'fact_{fact_j}']}
+                                                     for fact_j in range(len(facts)) if fact_j not in remaining}
+            jobs += [(id, fact_j, make_fact_eval_prompt(proto_summary, facts[fact_j])) for fact_j in remaining]
+        self.fact_eval_prescreened = sum(len(votes) for votes in self.fact_eval_votes.values())
+        votes, self.fact_eval_calls = self._ask_judges([prompt for _, _, prompt in jobs],
+                                                       [{"stage": "fact_eval", "patient": id, "fact": fact_j} for id, fact_j, _ in jobs], "fact_mentioned")
+        for (id, fact_j, _), item in zip(jobs, votes):
+            for results in (self.fact_eval_res, self.fact_eval_expl, self.fact_eval_votes):
+                results.setdefault(f'patient_{id}', {})
+            self.fact_eval_res[f'patient_{id}'][f'fact_{fact_j}'] = self._aggregate([value for value, _ in item.values()], "fact_mentioned")
+            self.fact_eval_votes[f'patient_{id}'][f'fact_{fact_j}'] = {provider: value for provider, (value, _) in item.items()}
+            self.fact_eval_expl[f'patient_{id}'][f'fact_{fact_j}'] = {provider: expl for provider, (_, expl) in item.items()}
+        self.fact_eval_judge_agreement = self._agreement(votes, self.fact_eval_calls, "fact_mentioned")
+        return self.fact_eval_judge_agreement
+
+    def unconditional_eval(self):
+        # unc_eval_res holds the aggregated scores, unc_eval_votes / unc_eval_expl the score / explanation of each judge
+        self.unc_eval_res = {}
+        self.unc_eval_expl = {}
+        self.unc_eval_votes = {}
+        self.failed_calls, self.failed_patients = 0, set()
+        jobs = [(id, make_llm_as_judge_prompt(proto_summary)) for id, proto_summary, _ in self._patients()]
+        votes, self.unc_eval_calls = self._ask_judges([prompt for _, prompt in jobs],
+                                                      [{"stage": "unconditional_eval", "patient": id} for id, _ in jobs], "score")
+        for (id, _), item in zip(jobs, votes):
+            self.unc_eval_res[f'patient_{id}'] = self._aggregate([value for value, _ in item.values()], "score")
+            self.unc_eval_votes[f'patient_{id}'] = {provider: value for provider, (value, _) in item.items()}
+            self.unc_eval_expl[f'patient_{id}'] = {provider: expl for provider, (_, expl) in item.items()}
+        self.unc_eval_judge_agreement = self._agreement(votes, self.unc_eval_calls, "score")
+        return self.unc_eval_judge_agreement
 
 if __name__ == "__main__": 
-    autoeval_ins = AutoEval((gpt4o, openai_call), "gpt-4o")
+    # One evaluation of the gpt-4o prototype summaries by the gpt-4o judge. Other entry points, each a full (paid) evaluation:
+    # - autoeval_ins.fact_eval(batched=True), compare_fact_eval_modes(): three facts per judge call, and its agreement
+    #   with single-fact calls
+    # - AutoEval(..., prescreen=FactPrescreen()), calibrate_prescreen(): facts found almost verbatim resolved locally
+    # - AutoEvalEnsemble(my_llms, "gpt-4o", quorum=2): several judges, the third one only asked when the first two disagree
+    # - run_checkpointed("fact_eval", run_store.RunStore("../../cache/runs/auto_eval")): resumable, patient by patient
+    # Rate limits, retries with backoff, circuit breaking and hedging of slow calls for the judge
+    judge_pair = resilient_pair(*get_backend("gpt-4o"), "gpt-4o", requests_per_minute=500, tokens_per_minute=800_000, hedge_after=30)
+    autoeval_ins = AutoEval(judge_pair, "gpt-4o", cache=ResponseCache("../../cache/llm_responses.sqlite"), max_workers=16)
     autoeval_ins.facts
     autoeval_ins.proto_summaries
     autoeval_ins.proto_facts_merged
@@ -159,4 +673,7 @@ if __name__ == "__main__":
     autoeval_ins.fact_eval_expl
     autoeval_ins.unconditional_eval()
     autoeval_ins.unc_eval_res
-    autoeval_ins.unc_eval_expl
\ No newline at end of file
+    autoeval_ins.unc_eval_expl
+    autoeval_ins.cache.stats()
+    judge_pair[1].resilience.stats
+    json_parse_stats
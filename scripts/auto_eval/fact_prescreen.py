@@ -0,0 +1,132 @@
+import re
+from difflib import SequenceMatcher
+from functools import lru_cache
+import pandas as pd
+
+# Local pre-screen of the (summary, fact) pairs of AutoEval.fact_eval: facts found almost verbatim in the summary are
+# marked as mentioned without a judge call, the others go to the judge.
+#   autoeval = AutoEval(judge_pair, "gpt-4o", prescreen=FactPrescreen(accept_above=0.9))
+#   report, table = autoeval.calibrate_prescreen()
+# Summary and fact are lowercased, clinical abbreviations are expanded (htn -> hypertension, s/p -> status post, ...),
+# stop words dropped and plurals folded. The confidence of a pair is the largest share of the fact's terms found
+# in order within a window of the summary, halved when only one of the fact and the window is negated.
+
+abbreviations = {
+    "abx": "antibiotics", "afib": "atrial fibrillation", "aki": "acute kidney injury", "ams": "altered mental status",
+    "bid": "twice daily", "bp": "blood pressure", "cabg": "coronary artery bypass graft", "cad": "coronary artery disease",
+    "chf": "congestive heart failure", "ckd": "chronic kidney disease", "copd": "chronic obstructive pulmonary disease",
+    "cp": "chest pain", "cta": "computed tomography angiography", "ct": "computed tomography", "cva": "stroke",
+    "cxr": "chest x ray", "d/c": "discharge", "dc": "discharge", "dka": "diabetic ketoacidosis", "dm": "diabetes mellitus",
+    "dvt": "deep vein thrombosis", "dx": "diagnosis", "ecg": "electrocardiogram", "echo": "echocardiogram",
+    "ed": "emergency department", "egd": "esophagogastroduodenoscopy", "ekg": "electrocardiogram",
+    "esrd": "end stage renal disease", "etoh": "alcohol", "gerd": "gastroesophageal reflux disease", "gi": "gastrointestinal",
+    "hf": "heart failure", "hfref": "heart failure reduced ejection fraction", "hgb": "hemoglobin", "hld": "hyperlipidemia",
+    "htn": "hypertension", "hx": "history", "icu": "intensive care unit", "iv": "intravenous", "lft": "liver function test",
+    "lvef": "left ventricular ejection fraction", "mi": "myocardial infarction", "mri": "magnetic resonance imaging",
+    "n/v": "nausea vomiting", "nstemi": "non st elevation myocardial infarction", "osa": "obstructive sleep apnea",
+    "pe": "pulmonary embolism", "picc": "peripherally inserted central catheter", "pna": "pneumonia", "po": "by mouth",
+    "prn": "as needed", "qd": "daily", "r/o": "rule out", "s/p": "status post", "sob": "shortness of breath",
+    "stemi": "st elevation myocardial infarction", "tid": "three times daily", "tte": "transthoracic echocardiogram",
+    "tx": "treatment", "uti": "urinary tract infection", "w/": "with", "wbc": "white blood cell", "w/o": "without",
+}
+negations = {"no", "not", "denies", "denied", "negative", "without", "absent", "none", "never", "ruled"}
+stop_words = set("""a an and are as at be been by for from had has have he her his in is it its of on or patient she that the
+                    s their there this to was were which with""".split())
+token = re.compile(r"[a-z0-9]+(?:[/.][a-z0-9]+)*/?")
+
+def fold(term):
+    # Plural folding: "infiltrates" -> "infiltrate", "studies" -> "study"
+    if len(term) > 4 and term.endswith("ies"):
+        return term[:-3] + "y"
+    if len(term) > 3 and term.endswith("s") and not term.endswith(("ss", "us", "is")):
+        return term[:-1]
+    return term
+
+def normalize(text):
+    # Terms of a text, abbreviations expanded, stop words dropped (negations are kept)
+    terms = []
+    for raw in token.findall(text.lower()):
+        expansion = abbreviations.get(raw) or abbreviations.get(raw.rstrip("/"))
+        parts = expansion.split() if expansion else [part for part in re.split(r"[/]", raw) if part]
+        terms += [fold(term) for term in parts if term not in stop_words]
+    return tuple(terms)
+
+@lru_cache(maxsize=1024)
+def normalized_summary(summary):
+    # Terms of a summary and the positions of each term, a summary being screened against its three facts
+    terms = normalize(summary)
+    positions = {}
+    for position, term in enumerate(terms):
+        positions.setdefault(term, []).append(position)
+    return terms, positions
+
+def is_negated(terms):
+    return any(term in negations for term in terms)
+
+class FactPrescreen:
+    # accept_above: confidence from which a fact is marked as mentioned (1) without a judge call.
+    # reject_below: confidence up to which a fact is marked as not mentioned (0), None to always ask the judge
+    # (paraphrases such as "lasix" for "furosemide" score low, see calibrate_prescreen before enabling it).
+    # window_slack: the fact's terms may be spread over window_slack times as many summary terms
+    def __init__(self, accept_above=0.9, reject_below=None, window_slack=2.0):
+        self.accept_above = accept_above
+        self.reject_below = reject_below
+        self.window_slack = window_slack
+
+    def score(self, summary, fact):
+        # (confidence in [0, 1], summary terms of the best window)
+        if not isinstance(summary, str) or not isinstance(fact, str):
+            return 0.0, ""
+        fact_terms = normalize(fact)
+        content = [term for term in fact_terms if term not in negations]
+        if not content:
+            return 0.0, ""
+        terms, positions = normalized_summary(summary)
+        width = max(len(fact_terms), int(len(fact_terms) * self.window_slack))
+        starts = sorted({position for term in set(content) for position in positions.get(term, ())})
+        best, best_window = 0.0, ()
+        for start in starts:
+            window = terms[start:start + width]
+            matcher = SequenceMatcher(None, content, [term for term in window if term not in negations], autojunk=False)
+            matched = sum(block.size for block in matcher.get_matching_blocks()) / len(content)
+            # A negation just before the window counts as part of it ("no evidence of pneumonia")
+            if is_negated(terms[max(0, start - 3):start + width]) != is_negated(fact_terms):
+                matched /= 2
+            if matched > best:
+                best, best_window = matched, window
+                if best == 1.0:
+                    break
+        return best, " ".join(best_window)
+
+    def decide(self, summary, fact):
+        # (confidence, 1.0 / 0.0 when resolved locally or None for the judge, explanation)
+        confidence, evidence = self.score(summary, fact)
+        if confidence >= self.accept_above:
+            return confidence, 1.0, f"Local pre-screen: {confidence:.0%} of the fact's terms found in order in the summary ({evidence!r})."
+        if self.reject_below is not None and confidence <= self.reject_below:
+            return confidence, 0.0, f"Local pre-screen: only {confidence:.0%} of the fact's terms found in order in the summary."
+        return confidence, None, None
+
+def calibration_report(confidences, judged, prescreen, thresholds=(0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.0)):
+    # Local decisions against the judge's answers (1 / 0, nan when the judge failed) for the same pairs.
+    # Returns the summary at the prescreen's thresholds and one row per threshold: share of the pairs at or above it and
+    # how often the judge said "mentioned" there, share at or below it and how often the judge said "not mentioned"
+    df = pd.DataFrame({"confidence": confidences, "judge": judged}).dropna()
+    accepted = df["confidence"] >= prescreen.accept_above
+    rejected = df["confidence"] <= prescreen.reject_below if prescreen.reject_below is not None else pd.Series(False, index=df.index)
+    local = df[accepted | rejected]
+    agree = (accepted & (df["judge"] == 1)) | (rejected & (df["judge"] == 0))
+    report = {"pairs": len(confidences), "judged": len(df), "resolved_locally": int(len(local)),
+              "call_savings": len(local) / len(df) if len(df) else float('nan'),
+              "agreement": float(agree[accepted | rejected].mean()) if len(local) else float('nan'),
+              "accepted": int(accepted.sum()), "false_accepts": int((accepted & (df["judge"] == 0)).sum()),
+              "rejected": int(rejected.sum()), "false_rejects": int((rejected & (df["judge"] == 1)).sum())}
+    rows = []
+    for threshold in thresholds:
+        above, below = df[df["confidence"] >= threshold], df[df["confidence"] <= threshold]
+        rows.append({"threshold": threshold,
+                     "share_above": len(above) / len(df) if len(df) else float('nan'),
+                     "judge_mentioned_above": float((above["judge"] == 1).mean()) if len(above) else float('nan'),
+                     "share_below": len(below) / len(df) if len(df) else float('nan'),
+                     "judge_not_mentioned_below": float((below["judge"] == 0).mean()) if len(below) else float('nan')})
+    return report, pd.DataFrame(rows).set_index("threshold")
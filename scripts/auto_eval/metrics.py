@@ -0,0 +1,208 @@
+import argparse
+import math
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+# Local reference-based metrics: ROUGE-L (LCS) and BLEU of predicted hospital courses against brief_hospital_course.
+#   per_patient, corpus = score_predictions(summarizer.batch_results, testset)
+#   corpus_table = score_systems({"gemini": gemini_df, "gpt-4o": gpt4o_df}, testset)
+# ROUGE-L is computed on lowercased texts split on non-alphanumeric characters (as rouge-score does), BLEU on
+# case-preserving 13a tokens (sacrebleu's defaults: corpus_bleu / sentence_bleu with tokenize="13a", exp smoothing).
+# The LCS is computed bit-parallel (one big-int operation per predicted token instead of one per token pair) and the
+# pairs are sharded over processes, each reference being tokenized and indexed once for all the systems scored against it.
+
+max_order = 4
+non_alnum = re.compile(r"[^a-z0-9]+")
+# mteval-v13a tokenization, as sacrebleu's Tokenizer13a
+bleu_token_rules = [(re.compile(r"([\{-\~\[-\` -\&\(-\+\:-\@\/])"), r" \1 "),
+                    (re.compile(r"([^0-9])([\.,])"), r"\1 \2 "),
+                    (re.compile(r"([\.,])([^0-9])"), r" \1 \2"),
+                    (re.compile(r"([0-9])(-)"), r"\1 \2 ")]
+
+@lru_cache(maxsize=8192)
+def tokenize(text):
+    return tuple(non_alnum.sub(" ", text.lower()).split())
+
+@lru_cache(maxsize=8192)
+def bleu_tokenize(text):
+    line = text.rstrip().replace("<skipped>", "").replace("-\n", "").replace("\n", " ")
+    if "&" in line:
+        line = line.replace("&quot;", '"').replace("&amp;", "&").replace("&lt;", "<").replace("&gt;", ">")
+    line = f" {line} "
+    for rule, replacement in bleu_token_rules:
+        line = rule.sub(replacement, line)
+    return tuple(line.split())
+
+def ngram_counts(tokens, n):
+    return Counter(zip(*[tokens[i:] for i in range(n)]))
+
+@lru_cache(maxsize=2048)
+def reference_profile(text):
+    # Tokens of a reference and bitmask of the positions of each token (for the LCS), BLEU length and n-gram counts
+    tokens = tokenize(text)
+    masks = {}
+    for position, token in enumerate(tokens):
+        masks[token] = masks.get(token, 0) | (1 << position)
+    bleu_tokens = bleu_tokenize(text)
+    return tokens, masks, len(bleu_tokens), [ngram_counts(bleu_tokens, n) for n in range(1, max_order + 1)]
+
+def lcs_length(masks, ref_len, tokens):
+    # Bit-parallel LCS (Allison-Dix / Hyyro): bit i of v is cleared once reference token i is part of the LCS
+    all_ones = (1 << ref_len) - 1
+    v = all_ones
+    for token in tokens:
+        u = v & masks.get(token, 0)
+        v = ((v + u) | (v - u)) & all_ones
+    return ref_len - bin(v).count("1")
+
+def pair_stats(reference, prediction):
+    # Sufficient statistics of one pair: lcs, prediction length, reference length (ROUGE tokens),
+    # prediction length, reference length, matches and totals per order (BLEU tokens)
+    ref_tokens, masks, ref_bleu_len, ref_ngrams = reference_profile(reference)
+    tokens = tokenize(prediction)
+    bleu_tokens = bleu_tokenize(prediction)
+    matches = []
+    totals = []
+    for n in range(1, max_order + 1):
+        counts = ngram_counts(bleu_tokens, n)
+        matches.append(sum(min(count, ref_ngrams[n - 1][ngram]) for ngram, count in counts.items()))
+        totals.append(max(0, len(bleu_tokens) - n + 1))
+    return (lcs_length(masks, len(ref_tokens), tokens), len(tokens), len(ref_tokens), len(bleu_tokens), ref_bleu_len, *matches, *totals)
+
+def score_shard(shard):
+    # shard: [(reference, (prediction of system 1, prediction of system 2, ...)), ...], None for a missing prediction
+    return [[pair_stats(reference, prediction) if isinstance(prediction, str) else None for prediction in predictions]
+            for reference, predictions in shard]
+
+def rouge_l(lcs, pred_len, ref_len, beta=1.0):
+    precision = lcs / pred_len if pred_len else 0.0
+    recall = lcs / ref_len if ref_len else 0.0
+    if precision == 0 or recall == 0:
+        return precision, recall, 0.0
+    return precision, recall, (1 + beta**2) * precision * recall / (recall + beta**2 * precision)
+
+def bleu(matches, totals, pred_len, ref_len, effective_order=True):
+    # BLEU with the "exp" smoothing of sacrebleu: an order without any match counts as 1 / (2^k * total).
+    # effective_order (sentence_bleu's default): orders without any n-gram in the prediction are left out of the mean,
+    # otherwise (corpus_bleu's default) they make the score 0
+    if not any(matches):
+        return 0.0
+    log_precisions = []
+    smooth = 1.0
+    for match, total in zip(matches, totals):
+        if total == 0:
+            break
+        if match == 0:
+            smooth *= 2
+            log_precisions.append(math.log(1 / (smooth * total)))
+        else:
+            log_precisions.append(math.log(match / total))
+    if not log_precisions or pred_len == 0 or (not effective_order and len(log_precisions) < len(totals)):
+        return 0.0
+    brevity_penalty = 1.0 if pred_len > ref_len else math.exp(1 - ref_len / pred_len)
+    return brevity_penalty * math.exp(sum(log_precisions) / len(log_precisions))
+
+def stats_to_scores(stats):
+    lcs, pred_len, ref_len, bleu_pred_len, bleu_ref_len = stats[:5]
+    precision, recall, fmeasure = rouge_l(lcs, pred_len, ref_len)
+    return {"rougeL_precision": precision, "rougeL_recall": recall, "rougeL_fmeasure": fmeasure,
+            "bleu": bleu(stats[5:5 + max_order], stats[5 + max_order:], bleu_pred_len, bleu_ref_len),
+            "prediction_tokens": pred_len, "reference_tokens": ref_len}
+
+def run_shards(references, predictions, max_workers=None, shard_size=32):
+    # Per-pair statistics of every system, computed in shards of shard_size references over max_workers processes
+    # (in this process when max_workers is 1 or when there is a single shard)
+    items = list(zip(references, zip(*predictions)))
+    shards = [items[i:i + shard_size] for i in range(0, len(items), shard_size)]
+    if max_workers == 1 or len(shards) <= 1:
+        results = map(score_shard, shards)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(score_shard, shards))
+    return [pair for shard in results for pair in shard]
+
+def summarize_system(pair_stats_list, index):
+    # Per-patient scores and corpus scores (mean ROUGE-L, corpus BLEU from the summed statistics) of one system
+    per_patient = pd.DataFrame([stats_to_scores(stats) if stats is not None else {} for stats in pair_stats_list], index=index)
+    scored = [stats for stats in pair_stats_list if stats is not None]
+    corpus = {"patients": len(pair_stats_list), "scored": len(scored)}
+    if scored:
+        totals = np.sum(scored, axis=0)
+        corpus.update(per_patient[["rougeL_precision", "rougeL_recall", "rougeL_fmeasure"]].mean().to_dict())
+        corpus["bleu"] = bleu(totals[5:5 + max_order], totals[5 + max_order:], totals[3], totals[4], effective_order=False)
+    return per_patient, corpus
+
+def aligned_references(index, references, reference_col):
+    if isinstance(references, pd.DataFrame):
+        references = references[reference_col]
+    return references.reindex(index)
+
+def score_systems(systems, references, prediction_col="predicted_brief_hospital_course", reference_col="brief_hospital_course",
+                  max_workers=None, shard_size=32):
+    # systems: {name: DataFrame with prediction_col (or Series)}, references: DataFrame with reference_col (or Series),
+    # aligned on the index. Returns the corpus scores (one row per system) and the per-patient scores of each system
+    names = list(systems)
+    series = [systems[name][prediction_col] if isinstance(systems[name], pd.DataFrame) else systems[name] for name in names]
+    index = series[0].index
+    for other in series[1:]:
+        index = index.union(other.index, sort=False)
+    reference_texts = aligned_references(index, references, reference_col)
+    keep = reference_texts.map(lambda text: isinstance(text, str))
+    index = index[keep.to_numpy()]
+    predictions = [s.reindex(index).tolist() for s in series]
+    stats = run_shards(reference_texts[index].tolist(), predictions, max_workers, shard_size)
+    per_patient = {}
+    corpus = {}
+    for system_i, name in enumerate(names):
+        per_patient[name], corpus[name] = summarize_system([pair[system_i] for pair in stats], index)
+    return pd.DataFrame.from_dict(corpus, orient="index"), per_patient
+
+def score_predictions(predictions, references=None, prediction_col="predicted_brief_hospital_course", reference_col="brief_hospital_course",
+                      max_workers=None, shard_size=32):
+    # Score one system. Without references, the predictions DataFrame must also have reference_col
+    references = references if references is not None else predictions
+    corpus, per_patient = score_systems({"predictions": predictions}, references, prediction_col, reference_col, max_workers, shard_size)
+    return per_patient["predictions"], corpus.loc["predictions"].to_dict()
+
+def check_against_packages(references, predictions):
+    # Largest differences with rouge-score and sacrebleu (default settings) on the same (reference, prediction) pairs,
+    # all of them ~0 when the local implementation is right. Needs both packages
+    import sacrebleu
+    from rouge_score import rouge_scorer
+    scorer = rouge_scorer.RougeScorer(["rougeL"])
+    stats = [pair_stats(reference, prediction) for reference, prediction in zip(references, predictions)]
+    scores = [stats_to_scores(pair) for pair in stats]
+    totals = np.sum(stats, axis=0)
+    return {"pairs": len(stats),
+            "rougeL_fmeasure": max(abs(score["rougeL_fmeasure"] - scorer.score(reference, prediction)["rougeL"].fmeasure)
+                                   for score, reference, prediction in zip(scores, references, predictions)),
+            "sentence_bleu": max(abs(score["bleu"] - sacrebleu.sentence_bleu(prediction, [reference]).score / 100)
+                                 for score, reference, prediction in zip(scores, references, predictions)),
+            "corpus_bleu": abs(bleu(totals[5:5 + max_order], totals[5 + max_order:], totals[3], totals[4], effective_order=False)
+                               - sacrebleu.corpus_bleu(list(predictions), [list(references)]).score / 100)}
+
+if __name__ == "__main__":
+    # e.g. python metrics.py ../../pickle/train_test_dfs/testset.pkl gemini=../../exports/gemini_testset_results.pkl
+    parser = argparse.ArgumentParser(description="ROUGE-L and BLEU of predicted hospital courses")
+    parser.add_argument("references", help="pickled DataFrame with brief_hospital_course")
+    parser.add_argument("systems", nargs="+", help="name=path of a pickled DataFrame with predicted_brief_hospital_course")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--output", help="write the per-patient scores of every system as CSV")
+    parser.add_argument("--check", action="store_true", help="compare with rouge-score and sacrebleu on the first system")
+    args = parser.parse_args()
+
+    references = pd.read_pickle(args.references)
+    systems = {name: pd.read_pickle(path) for name, path in (system.split("=", 1) for system in args.systems)}
+    corpus, per_patient = score_systems(systems, references, max_workers=args.workers)
+    print(corpus)
+    if args.check:
+        first = next(iter(systems.values()))["predicted_brief_hospital_course"].dropna()
+        texts = references["brief_hospital_course"].reindex(first.index)
+        keep = texts.map(lambda text: isinstance(text, str)).to_numpy()
+        print(check_against_packages(texts[keep].tolist(), first[keep].tolist()))
+    if args.output:
+        pd.concat(per_patient, names=["system", "patient"]).to_csv(args.output)
@@ -0,0 +1,102 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from pathlib import Path
+import pandas as pd
+
+# SQLite manifest of the prototype summaries, testset/patient_{i}/{model}.md, for every model at once.
+# A refresh walks the directory once, and only reads the files whose mtime or size changed (a file whose content hash
+# did not change keeps its row). Loading the summaries of one model, or of all models, is then a single query.
+#   index = open_summary_index("../prototyping/generated_dc_sum/testset")
+#   index.summaries("gpt-4o")            # patient_i, summary
+#   index.load(["gpt-4o", "gemini"])    # model, patient_i, summary
+
+class SummaryIndex:
+    def __init__(self, test_path, index_path=None):
+        self.test_path = Path(test_path)
+        # Next to the summaries by default, the leading dot keeps it out of the *.md listings
+        self.index_path = Path(index_path if index_path is not None else self.test_path / ".summary_index.sqlite")
+        self.lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS summaries (
+                            model TEXT NOT NULL, patient_i INTEGER NOT NULL, path TEXT NOT NULL,
+                            mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, sha1 TEXT NOT NULL, summary TEXT NOT NULL,
+                            PRIMARY KEY (model, patient_i))""")
+            conn.execute("CREATE INDEX IF NOT EXISTS summaries_path ON summaries(path)")
+
+    def _connect(self):
+        return sqlite3.connect(self.index_path, timeout=60)
+
+    def _scan(self):
+        # (model, patient_i, path relative to test_path, stat) of every {model}.md under a patient_* directory
+        for root, _, files in os.walk(self.test_path):
+            patient_dirs = [part for part in Path(root).relative_to(self.test_path).parts if "patient_" in part]
+            if not patient_dirs:
+                continue
+            patient_i = int(''.join(filter(str.isdigit, patient_dirs[0])))
+            for name in files:
+                if name.endswith(".md"):
+                    path = Path(root) / name
+                    yield name[:-3], patient_i, path.relative_to(self.test_path).as_posix(), path.stat()
+
+    def refresh(self):
+        # Bring the manifest up to date with the directory, returns what was done
+        report = {"files": 0, "read": 0, "updated": 0, "removed": 0}
+        with self.lock, self._connect() as conn:
+            known = {path: (mtime_ns, size, sha1) for path, mtime_ns, size, sha1 in conn.execute("SELECT path, mtime_ns, size, sha1 FROM summaries")}
+            seen = set()
+            for model, patient_i, rel_path, stat in self._scan():
+                report["files"] += 1
+                seen.add(rel_path)
+                if rel_path in known and known[rel_path][:2] == (stat.st_mtime_ns, stat.st_size):
+                    continue
+                content = (self.test_path / rel_path).read_bytes()
+                report["read"] += 1
+                sha1 = hashlib.sha1(content).hexdigest()
+                if rel_path in known and known[rel_path][2] == sha1:
+                    # touched but unchanged
+                    conn.execute("UPDATE summaries SET mtime_ns = ?, size = ? WHERE path = ?", (stat.st_mtime_ns, stat.st_size, rel_path))
+                    continue
+                # The first paragraph is the title of the file
+                text = content.decode("utf-8")
+                summary = text.split("\n\n", 1)[1] if "\n\n" in text else text
+                conn.execute("INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (model, patient_i, rel_path, stat.st_mtime_ns, stat.st_size, sha1, summary))
+                report["updated"] += 1
+            removed = [(path,) for path in known if path not in seen]
+            conn.executemany("DELETE FROM summaries WHERE path = ?", removed)
+            report["removed"] = len(removed)
+        return report
+
+    def models(self):
+        with self._connect() as conn:
+            return [model for model, in conn.execute("SELECT DISTINCT model FROM summaries ORDER BY model")]
+
+    def load(self, models=None):
+        # Summaries of the given models (all models if None) as a DataFrame: model, patient_i, summary
+        query = "SELECT model, patient_i, summary FROM summaries"
+        params = []
+        if models is not None:
+            models = [models] if isinstance(models, str) else list(models)
+            query += f" WHERE model IN ({', '.join('?' * len(models))})"
+            params = models
+        with self._connect() as conn:
+            return pd.read_sql_query(query + " ORDER BY model, patient_i", conn, params=params)
+
+    def summaries(self, model):
+        # Summaries of one model in the format used by AutoEval: patient_i, summary
+        return self.load([model])[["patient_i", "summary"]]
+
+summary_indexes = {}
+summary_indexes_lock = threading.Lock()
+
+def open_summary_index(test_path, index_path=None):
+    # One index per directory and process, refreshed when first opened: comparing several models walks the directory once
+    key = (Path(test_path).resolve(), index_path)
+    with summary_indexes_lock:
+        if key not in summary_indexes:
+            index = SummaryIndex(test_path, index_path)
+            index.refresh()
+            summary_indexes[key] = index
+        return summary_indexes[key]
@@ -0,0 +1,13 @@
+from auto_eval import llm_output_to_json
+
+# Run from scripts/auto_eval: python -m pytest test_auto_eval.py
+
+def test_brace_in_preamble():
+    # The first {...} holds no judge field, the next one is used
+    parsed = llm_output_to_json('Sure {here} is: {"explanation": "Furosemide is mentioned.", "fact_mentioned": 1}')
+    assert parsed == {"explanation": "Furosemide is mentioned.", "fact_mentioned": 1.0}
+
+def test_unescaped_quotes_in_explanation():
+    # Not valid JSON: the explanation is recovered up to its closing quote, not cut at the first inner one
+    parsed = llm_output_to_json('{"explanation": "The summary says "pneumonia" in the Primary Diagnosis section.", "fact_mentioned": 1}')
+    assert parsed == {"explanation": 'The summary says "pneumonia" in the Primary Diagnosis section.', "fact_mentioned": 1.0}
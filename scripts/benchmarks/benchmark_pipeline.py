@@ -0,0 +1,200 @@
+import argparse
+import json
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+scripts_dir = Path(__file__).resolve().parents[1]
+sys.path += [str(scripts_dir / "common"), str(scripts_dir / "solutions"), str(scripts_dir / "auto_eval")]
+from mock_llm import mock_init, mock_call, mock_response, MockStats, vocabulary
+from resilience import resilient_pair
+from note_parser import parse_record, hashes, next_note, note_header, date_format
+from note_scheduler import NoteScheduler
+import clinically_informed_workflow as workflow
+
+# Offline throughput / latency benchmark of the summarizer and the evaluator on synthetic patients,
+# with the mock backend standing in for the LLM. Run from scripts/benchmarks:
+#   python benchmark_pipeline.py --patients 50 --mean-latency 0.05 --output ../../bench_output.json
+
+def synthetic_inputs(n_notes, note_words, rng):
+    # An `inputs` text with an H&P and n_notes progress notes, last note first as in the benchmark
+    start = pd.Timestamp("2023-01-01 08:00:00") + pd.Timedelta(days=rng.randint(0, 300))
+    words = lambda: "\n\n".join(" ".join(rng.choice(vocabulary) for _ in range(max(1, note_words // 4))) for _ in range(4))
+    dates = [start + pd.Timedelta(hours=12 * i) for i in range(n_notes + 1)]
+    h_p = f"h_p: {note_header}: {dates[0].strftime(date_format)}\nHistory & Physical\n{words()}"
+    notes = [f"{note_header}: {date.strftime(date_format)}\nProgress Note\n{words()}" for date in dates[1:]][::-1]
+    return f"{hashes}\n{h_p}\n\n{hashes}\nprogress_notes: " + f"\n\n{next_note}\n".join(notes)
+
+def synthetic_patients(n_patients, min_notes=2, max_notes=40, note_words=400, seed=0):
+    rng = random.Random(seed)
+    return pd.DataFrame({"inputs": [synthetic_inputs(rng.randint(min_notes, max_notes), note_words, rng) for _ in range(n_patients)]})
+
+def percentiles(values):
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return {"p50": float("nan"), "p99": float("nan")}
+    return {"p50": float(np.percentile(values, 50)), "p99": float(np.percentile(values, 99))}
+
+def bench_prompt_building(df):
+    # CPU time to parse every patient and build every prompt of the chain, without any model call
+    parse_record.cache_clear()
+    start = time.process_time()
+    for example_input in df["inputs"]:
+        parse_record(example_input)
+    parse_s = time.process_time() - start
+    start = time.process_time()
+    n_prompts = 0
+    for example_input in df["inputs"]:
+        workflow.make_prompt_1(example_input)
+        for i in range(parse_record(example_input).no_of_other_notes):
+            workflow.make_prompt_2(example_input, "draft", i)
+        workflow.make_prompt_3(example_input, "draft")
+        n_prompts += 2 + parse_record(example_input).no_of_other_notes
+    return {"stage": "prompt_building", "patients": len(df), "calls": n_prompts, "parse_cpu_s": parse_s, "prompt_cpu_s": time.process_time() - start}
+
+# Provider SDKs that no module should import before a backend is resolved (see backends.py)
+sdk_modules = ("vertexai", "openai", "anthropic", "agnostic_evaluator_models")
+import_probe = """
+import json, sys, time
+sys.path += {path!r}
+start = time.perf_counter()
+import {module}
+print(json.dumps([time.perf_counter() - start, sorted(name for name in {sdks!r} if name in sys.modules)]))
+"""
+
+def bench_import_time(modules=("note_parser", "clinically_informed_workflow", "auto_eval", "metrics"), repeats=3):
+    # Wall time to import each module in a fresh interpreter (what every process-pool worker pays), best of repeats,
+    # and the SDKs it pulled in
+    results = []
+    for module in modules:
+        times = []
+        for _ in range(repeats):
+            probe = import_probe.format(path=[str(scripts_dir / name) for name in ("common", "solutions", "auto_eval")], module=module, sdks=sdk_modules)
+            output = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True, check=True).stdout
+            import_s, sdks = json.loads(output.splitlines()[-1])
+            times.append(import_s)
+        results.append({"stage": f"import_{module}", "import_s": min(times), "sdk_modules": ",".join(sdks)})
+    return results
+
+def bench_summarizer(df, strategy, mock_kwargs, max_workers, resilience=None, scheduler=None):
+    # resilience: options of resilience.Resilience to run the calls through retries / hedging, None for bare calls.
+    # scheduler: NoteScheduler of the adaptive chain
+    stats = MockStats()
+    pair = (partial(mock_init, stats=stats, **mock_kwargs), mock_call)
+    if resilience is not None:
+        pair = resilient_pair(*pair, f"mock-{strategy}", **resilience)
+    summarizer = workflow.DC_summarizer(*pair, max_concurrency=max_workers, strategy=strategy, scheduler=scheduler)
+    start = time.perf_counter()
+    results = summarizer.summarize_many(df, max_workers=max_workers, verbose=False)
+    wall_s = time.perf_counter() - start
+    per_patient = percentiles(results["time_to_summarize"])
+    per_call = percentiles(stats.latencies)
+    return {"stage": f"summarize_{strategy}" + ("_adaptive" if scheduler is not None else ""), "patients": len(df), "wall_s": wall_s, "patients_per_s": len(df) / wall_s,
+            "patient_p50_s": per_patient["p50"], "patient_p99_s": per_patient["p99"],
+            "call_p50_s": per_call["p50"], "call_p99_s": per_call["p99"],
+            "failed_patients": int(results["error"].notna().sum()), **stats.summary(),
+            **({f"resilience_{key}": value for key, value in pair[1].resilience.stats.items()} if resilience is not None else {})}
+
+def write_eval_fixtures(df, eval_dir, rng):
+    # Files in the layout read by AutoEval: testset/patient_{i}/{model}.md and the facts CSV
+    test_path = Path(eval_dir) / "testset"
+    rows = []
+    for patient_i in range(len(df)):
+        patient_dir = test_path / f"patient_{patient_i}"
+        patient_dir.mkdir(parents=True, exist_ok=True)
+        summary = " ".join(rng.choice(vocabulary) for _ in range(300))
+        (patient_dir / "mock.md").write_text(f"# mock\n\n{summary}", encoding="utf-8")
+        facts = [" ".join(rng.choice(vocabulary) for _ in range(8)) for _ in range(3)]
+        rows.append([f"patient {patient_i + 1}", "", "", facts[0], "", facts[1], "", facts[2]])
+    fact_df_path = Path(eval_dir) / "facts.csv"
+    pd.DataFrame(rows).to_csv(fact_df_path, index=False)
+    return test_path, fact_df_path
+
+def bench_judge_prompt_building(autoeval, stage, seed=0):
+    # CPU time to build every judge prompt of an evaluation stage and to parse the judge outputs, without any model call
+    import auto_eval
+    patients = list(autoeval._patients())
+    start = time.process_time()
+    if stage == "fact_eval_batched":
+        prompts = [auto_eval.make_multi_fact_eval_prompt(proto_summary, facts) for _, proto_summary, facts in patients]
+    elif stage == "fact_eval":
+        prompts = [auto_eval.make_fact_eval_prompt(proto_summary, fact) for _, proto_summary, facts in patients for fact in facts]
+    else:
+        prompts = [auto_eval.make_llm_as_judge_prompt(proto_summary) for _, proto_summary, _ in patients]
+    prompt_s = time.process_time() - start
+    llm_outputs = [mock_response(prompt, 0, seed) for prompt in prompts]
+    parse = auto_eval.llm_output_to_json_list if stage == "fact_eval_batched" else auto_eval.llm_output_to_json
+    parse.cache_clear()
+    start = time.process_time()
+    for llm_output in llm_outputs:
+        parse(llm_output)
+    return {"parse_cpu_s": time.process_time() - start, "prompt_cpu_s": prompt_s}
+
+def bench_evaluator(df, mock_kwargs, max_workers, seed=0, resilience=None):
+    # resilience: as for bench_summarizer, applied to the judge calls. A judge call that still fails gives a NaN row,
+    # counted in failed_calls
+    from auto_eval import AutoEval
+    results = []
+    with tempfile.TemporaryDirectory() as eval_dir:
+        test_path, fact_df_path = write_eval_fixtures(df, eval_dir, random.Random(seed))
+        for stage in ("fact_eval", "fact_eval_batched", "unconditional_eval"):
+            stats = MockStats()
+            pair = (partial(mock_init, stats=stats, **mock_kwargs), mock_call)
+            if resilience is not None:
+                pair = resilient_pair(*pair, f"mock-{stage}", **resilience)
+            autoeval = AutoEval(pair, "mock", max_workers=max_workers, test_path=test_path, fact_df_path=fact_df_path)
+            start = time.perf_counter()
+            if stage == "fact_eval_batched":
+                autoeval.fact_eval(batched=True)
+            else:
+                getattr(autoeval, stage)()
+            wall_s = time.perf_counter() - start
+            per_call = percentiles(stats.latencies)
+            results.append({"stage": stage, "patients": len(df), "wall_s": wall_s, "patients_per_s": len(df) / wall_s,
+                            "call_p50_s": per_call["p50"], "call_p99_s": per_call["p99"],
+                            "failed_calls": autoeval.failed_calls, "failed_patients": len(autoeval.failed_patients), **stats.summary(),
+                            **bench_judge_prompt_building(autoeval, stage, seed),
+                            **({f"resilience_{key}": value for key, value in pair[1].resilience.stats.items()} if resilience is not None else {})})
+    return results
+
+def run_benchmarks(n_patients=20, min_notes=2, max_notes=40, note_words=400, mean_latency=0.05, error_rate=0.0, max_workers=16, seed=0, evaluator=True, resilience=None):
+    df = synthetic_patients(n_patients, min_notes, max_notes, note_words, seed)
+    mock_kwargs = {"mean_latency": mean_latency, "error_rate": error_rate, "seed": seed}
+    results = bench_import_time() + [bench_prompt_building(df)]
+    for strategy in workflow.summary_strategies:
+        results.append(bench_summarizer(df, strategy, mock_kwargs, max_workers, resilience))
+    results.append(bench_summarizer(df, "chain", mock_kwargs, max_workers, resilience, NoteScheduler()))
+    if evaluator:
+        results += bench_evaluator(df, mock_kwargs, max_workers, seed, resilience)
+    return pd.DataFrame(results).set_index("stage")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark of the summarization and evaluation pipeline")
+    parser.add_argument("--patients", type=int, default=20)
+    parser.add_argument("--min-notes", type=int, default=2)
+    parser.add_argument("--max-notes", type=int, default=40)
+    parser.add_argument("--note-words", type=int, default=400)
+    parser.add_argument("--mean-latency", type=float, default=0.05, help="median seconds per mock call")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--retries", type=int, help="run the summarizer and judge calls through the resilience layer with this many retries")
+    parser.add_argument("--hedge-after", type=float, help="with --retries, seconds before a slow call is hedged")
+    parser.add_argument("--no-evaluator", action="store_true", help="skip the AutoEval stages")
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    resilience = {"max_retries": args.retries, "base_delay": args.mean_latency, "hedge_after": args.hedge_after} if args.retries is not None else None
+    bench_res = run_benchmarks(args.patients, args.min_notes, args.max_notes, args.note_words, args.mean_latency,
+                               args.error_rate, args.workers, args.seed, evaluator=not args.no_evaluator, resilience=resilience)
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(bench_res)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": bench_res.reset_index().to_dict(orient="records")}, f, indent=2, default=str)
@@ -0,0 +1,78 @@
+import threading
+from functools import partial
+
+# Registry of the (model_init, model_call) pairs by name. The provider SDKs (vertexai, openai, anthropic, ...) are
+# imported by the factory of a backend when it is first resolved, not when a module using the registry is imported:
+# parsing, prompt building and process-pool workers never pay for them or need credentials.
+#   model_init, model_call = get_backend("gpt-4o")
+#   register_backend("my-model", lambda: (my_init, my_call))
+
+backends = {}
+resolved_backends = {}
+backends_lock = threading.Lock()
+
+def register_backend(name, factory):
+    # factory: no-argument function returning the (model_init, model_call) pair, called on first use only
+    with backends_lock:
+        backends[name] = factory
+        resolved_backends.pop(name, None)
+
+def backend(name):
+    # Decorator form of register_backend
+    def decorator(factory):
+        register_backend(name, factory)
+        return factory
+    return decorator
+
+def get_backend(name, **init_kwargs):
+    # (model_init, model_call) of a registered backend, init_kwargs bound to model_init
+    with backends_lock:
+        if name not in backends:
+            raise KeyError(f"Unknown backend {name!r}, registered: {', '.join(sorted(backends))}")
+        if name not in resolved_backends:
+            resolved_backends[name] = backends[name]()
+        model_init, model_call = resolved_backends[name]
+    return (partial(model_init, **init_kwargs) if init_kwargs else model_init), model_call
+
+def available_backends():
+    return sorted(backends)
+
+# Vertex AI (Gemini): for HIPAA compliance, everything remains in our Google Cloud Project
+def vertex_init(model_name, project=None):
+    import vertexai
+    from vertexai.preview.generative_models import GenerativeModel
+    if project is not None:
+        vertexai.init(project=project)
+    return {"loaded_model": GenerativeModel(model_name)}
+
+def vertex_call(input_txt, **kwargs):
+    response = kwargs["loaded_model"].generate_content([input_txt])
+    return response.candidates[0].content.parts[0].text
+
+def vertex_backend(model_name):
+    return partial(vertex_init, model_name), vertex_call
+
+for model_name in ("gemini-2.0-flash-exp", "gemini-1.5-pro"):
+    register_backend(model_name, partial(vertex_backend, model_name))
+
+# Judges of AutoEval, through the lab's agnostic_evaluator_models
+@backend("gpt-4o")
+def openai_backend():
+    from agnostic_evaluator_models import openai_init, openai_call, lab_key
+    return partial(openai_init, "gpt-4o", lab_key), openai_call
+
+@backend("claude-3-5-sonnet-v2")
+def anthropic_backend():
+    from agnostic_evaluator_models import anthropic_init, anthropic_call, lab_key
+    return partial(anthropic_init, "claude-3-5-sonnet-v2", lab_key), anthropic_call
+
+@backend("llama-3-3-70B-instruct")
+def meta_backend():
+    from agnostic_evaluator_models import meta_init, meta_call, lab_key
+    return partial(meta_init, "llama-3-3-70B-instruct", lab_key), meta_call
+
+# Offline stand-in, see mock_llm.py
+@backend("mock")
+def mock_backend():
+    from mock_llm import mock_init, mock_call
+    return mock_init, mock_call
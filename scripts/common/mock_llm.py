@@ -0,0 +1,85 @@
+import hashlib
+import json
+import random
+import threading
+import time
+
+# Offline stand-in for a (model_init, model_call) pair, e.g.
+#   DC_summarizer(partial(mock_init, mean_latency=0.5), mock_call)
+#   AutoEval((partial(mock_init, error_rate=0.01), mock_call))
+# Outputs are deterministic for a given (seed, prompt); latencies and errors are drawn per call.
+
+class MockLLMError(RuntimeError):
+    pass
+
+class MockStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.prompt_chars = 0
+        self.response_chars = 0
+        self.latencies = []
+
+    def record(self, prompt, response, latency, error):
+        with self.lock:
+            self.calls += 1
+            self.errors += error
+            self.prompt_chars += len(prompt)
+            self.response_chars += len(response)
+            self.latencies.append(latency)
+
+    def summary(self):
+        with self.lock:
+            return {"calls": self.calls, "errors": self.errors, "prompt_chars": self.prompt_chars, "response_chars": self.response_chars}
+
+def mock_init(model_name="mock-llm", latency="lognormal", mean_latency=1.0, latency_sigma=0.5, error_rate=0.0, output_words=400, seed=0, stats=None):
+    # latency: "fixed", "uniform" (0 to 2 x mean) or "lognormal" (median mean_latency, heavy right tail)
+    if latency not in ("fixed", "uniform", "lognormal"):
+        raise ValueError(f"Unknown latency distribution {latency!r}")
+    return {"model_name": model_name, "latency": latency, "mean_latency": mean_latency, "latency_sigma": latency_sigma,
+            "error_rate": error_rate, "output_words": output_words, "seed": seed,
+            "stats": stats if stats is not None else MockStats(), "call_rng": random.Random(seed)}
+
+vocabulary = ("patient admitted with acute decompensated heart failure treated diuresis furosemide improved "
+              "creatinine stable echocardiogram reduced ejection fraction pneumonia ceftriaxone cultures negative "
+              "discharged home follow up cardiology clinic weeks oxygen weaned room air ambulating independently").split()
+
+sections = ("Reason for Admission", "Relevant Medical History", "Relevant Surgical History", "Primary Diagnosis",
+            "Secondary Diagnoses", "Key Diagnostic Investigations and Results", "Therapeutic Procedures Performed",
+            "Medications", "Patient's Condition at Discharge")
+
+def mock_response(prompt, output_words, seed):
+    # The kind of answer is guessed from the prompt: batched facts, single fact, judge score or summary
+    rng = random.Random(hashlib.sha1(f"{seed}:{prompt}".encode("utf-8")).digest())
+    words = lambda n: " ".join(rng.choice(vocabulary) for _ in range(n))
+    if '"fact_id"' in prompt:
+        n_facts = prompt.count("\n    Fact ")
+        return json.dumps([{"fact_id": i, "explanation": words(40), "fact_mentioned": rng.randint(0, 1)} for i in range(n_facts)])
+    if '"fact_mentioned"' in prompt:
+        return json.dumps({"explanation": words(60), "fact_mentioned": rng.randint(0, 1)})
+    if '"score"' in prompt:
+        return json.dumps({"explanation": words(80), "score": rng.randint(1, 10)})
+    per_section = max(1, output_words // (len(sections) + 1))
+    body = "\n".join(f"{i+1}. {section}: {words(per_section)}" for i, section in enumerate(sections))
+    return f"{body}\n\nConclusion: {words(per_section)}"
+
+def draw_latency(rng, kwargs):
+    mean = kwargs["mean_latency"]
+    if kwargs["latency"] == "fixed":
+        return mean
+    if kwargs["latency"] == "uniform":
+        return rng.uniform(0, 2 * mean)
+    return rng.lognormvariate(0, kwargs["latency_sigma"]) * mean
+
+def mock_call(input_txt, **kwargs):
+    rng = kwargs["call_rng"]
+    with kwargs["stats"].lock:
+        latency = draw_latency(rng, kwargs)
+        error = rng.random() < kwargs["error_rate"]
+    time.sleep(latency)
+    response = "" if error else mock_response(input_txt, kwargs["output_words"], kwargs["seed"])
+    kwargs["stats"].record(input_txt, response, latency, error)
+    if error:
+        raise MockLLMError(f"{kwargs['model_name']}: simulated transient failure")
+    return response
@@ -0,0 +1,38 @@
+import threading
+import time
+
+class RateLimiter:
+    # Token bucket allowing `requests_per_minute` calls per minute on average, with bursts up to `burst`
+    def __init__(self, requests_per_minute, burst=None):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = float(burst if burst is not None else max(1, requests_per_minute // 6))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1.0):
+        # Block until `amount` tokens are available, then take them
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+# One limiter per provider, shared by every thread (and every AutoEval / DC_summarizer) calling it
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(provider, requests_per_minute, burst=None):
+    with rate_limiters_lock:
+        if provider not in rate_limiters:
+            rate_limiters[provider] = RateLimiter(requests_per_minute, burst)
+        return rate_limiters[provider]
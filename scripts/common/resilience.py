@@ -0,0 +1,180 @@
+import contextvars
+import random
+import threading
+import time
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from functools import wraps
+from rate_limiter import get_rate_limiter
+from telemetry import call_context
+
+# Resilience layer for any (model_init, model_call) pair, e.g.
+#   model_init, model_call = resilient_pair(model_init, model_call, "gemini", requests_per_minute=300, tokens_per_minute=2_000_000)
+# Every call then goes through: circuit breaker -> shared request/token buckets -> call (hedged when slow) -> retries
+# with exponential backoff and jitter. Limiters and breakers are shared by all wrappers of the same backend name.
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+class CircuitBreaker:
+    # Opens after `threshold` consecutive failures; after `reset_s` one probe call is let through (half-open)
+    # and closes the breaker again if it succeeds
+    def __init__(self, threshold=5, reset_s=60):
+        self.threshold = threshold
+        self.reset_s = reset_s
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.opens = 0
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.reset_s - time.monotonic()
+            if remaining > 0 or self.probing:
+                # seconds to wait before trying again, a probe may be running already when the reset time has passed
+                raise CircuitOpenError(remaining if remaining > 0 else min(self.reset_s, 1.0))
+            self.probing = True
+
+    def record(self, success):
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.probing or self.failures >= self.threshold:
+                    if self.opened_at is None or self.probing:
+                        self.opens += 1
+                    self.opened_at = time.monotonic()
+            self.probing = False
+
+    def release(self):
+        # The call ended with an error that says nothing about the backend (e.g. a prompt too long): the state is kept,
+        # another probe may be let through
+        with self.lock:
+            self.probing = False
+
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(backend, threshold=5, reset_s=60):
+    with circuit_breakers_lock:
+        if backend not in circuit_breakers:
+            circuit_breakers[backend] = CircuitBreaker(threshold, reset_s)
+        return circuit_breakers[backend]
+
+def start_call(call, input_txt, kwargs):
+    # Run one copy of a hedged call on its own thread (with the caller's context): no shared pool caps the concurrency
+    # of the callers or delays the start of a copy, so hedge_after only counts time spent in the call
+    future = Future()
+    def run():
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(call(input_txt, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+    threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True, name="hedged-call").start()
+    return future
+
+class Resilience:
+    def __init__(self, backend, requests_per_minute=None, tokens_per_minute=None, count_tokens=None,
+                 max_retries=5, base_delay=1.0, max_delay=60.0, hedge_after=None, max_hedges=1,
+                 breaker_threshold=5, breaker_reset=60, give_up_on=(ValueError, TypeError, KeyError)):
+        self.backend = backend
+        self.request_limiter = get_rate_limiter((backend, "requests"), requests_per_minute) if requests_per_minute else None
+        self.token_limiter = get_rate_limiter((backend, "tokens"), tokens_per_minute) if tokens_per_minute else None
+        # Tokens are estimated from the prompt before sending, 4 characters per token by default
+        self.count_tokens = count_tokens if count_tokens is not None else (lambda text: len(text) // 4 + 1)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # hedge_after: seconds after which a duplicate of a still running call is sent (at most max_hedges per attempt)
+        self.hedge_after = hedge_after
+        self.max_hedges = max_hedges
+        self.breaker = get_circuit_breaker(backend, breaker_threshold, breaker_reset)
+        # Errors that retrying cannot fix, e.g. prompt too long (PromptTooLongError is a ValueError)
+        self.give_up_on = give_up_on
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "failures": 0}
+        self.stats_lock = threading.Lock()
+
+    def _count(self, key, n=1):
+        with self.stats_lock:
+            self.stats[key] += n
+
+    def _throttle(self, input_txt):
+        if self.request_limiter is not None:
+            self.request_limiter.acquire()
+        if self.token_limiter is not None:
+            self.token_limiter.acquire(self.count_tokens(input_txt))
+
+    def _hedged(self, call, input_txt, kwargs):
+        # Send the call, and a duplicate each time hedge_after elapses without an answer; the first success wins
+        if self.hedge_after is None:
+            return call(input_txt, **kwargs)
+        original = start_call(call, input_txt, kwargs)
+        pending = {original}
+        hedges = 0
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=self.hedge_after if hedges < self.max_hedges else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not original:
+                        self._count("hedge_wins")
+                    return future.result()
+                error = error or future.exception()
+            if not done and hedges < self.max_hedges:
+                self._throttle(input_txt)
+                self._count("hedges")
+                hedges += 1
+                pending.add(start_call(call, input_txt, kwargs))
+        # every copy failed
+        raise error
+
+    def _backoff(self, attempt):
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def wrap(self, call):
+        @wraps(call)
+        def resilient_call(input_txt, **kwargs):
+            self._count("calls")
+            call_state = call_context.get().get("_call_state")
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self.breaker.before_call()
+                except CircuitOpenError as e:
+                    if attempt == self.max_retries:
+                        self._count("failures")
+                        raise
+                    time.sleep(e.args[0] * random.uniform(1, 1.2))
+                    continue
+                self._throttle(input_txt)
+                try:
+                    response = self._hedged(call, input_txt, kwargs)
+                except self.give_up_on:
+                    self.breaker.release()
+                    self._count("failures")
+                    raise
+                except Exception:
+                    self.breaker.record(False)
+                    if attempt == self.max_retries:
+                        self._count("failures")
+                        raise
+                    self._count("retries")
+                    if call_state is not None:
+                        call_state["retries"] += 1
+                    time.sleep(self._backoff(attempt))
+                    continue
+                self.breaker.record(True)
+                return response
+        return resilient_call
+
+def resilient_pair(model_init, model_call, backend, **kwargs):
+    # (model_init, model_call) with model_call going through a Resilience layer, see Resilience for the options
+    resilience = Resilience(backend, **kwargs)
+    resilient_call = resilience.wrap(model_call)
+    resilient_call.resilience = resilience
+    return model_init, resilient_call
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from functools import partial, wraps
+
+def plain_value(value):
+    # Settings as JSON values for the cache keys, dicts (e.g. a generation_config) being serialized with sorted keys by
+    # make_key. Other objects raise TypeError: calls differing only in them would share one key and each other's responses
+    if isinstance(value, (str, int, float, bool, type(None))):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [plain_value(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): plain_value(item) for key, item in value.items()}
+    raise TypeError(f"A setting of type {type(value).__name__} cannot be part of a cache key, pass the settings it holds as plain values")
+
+def name_value(value):
+    # Settings in a backend name, objects (e.g. a MockStats) by their type so that names stay stable across runs
+    try:
+        value = plain_value(value)
+    except TypeError:
+        return type(value).__name__
+    return json.dumps(value, sort_keys=True) if isinstance(value, (list, dict)) else value
+
+def backend_name(model_init):
+    # Readable name for an init function, e.g. partial(openai_init, "gpt-4o", key) -> "openai_init:gpt-4o",
+    # partial(openai_init, "gpt-4o", key, temperature=0) -> "openai_init:gpt-4o(temperature=0)".
+    # Positional arguments after the model name (credentials) are left out, see backend_params
+    if isinstance(model_init, partial):
+        name = getattr(model_init.func, "__qualname__", repr(model_init.func))
+        name = f"{name}:{model_init.args[0]}" if model_init.args else name
+        if model_init.keywords:
+            name += f"({', '.join(f'{key}={name_value(value)}' for key, value in sorted(model_init.keywords.items()))})"
+        return name
+    return getattr(model_init, "__qualname__", repr(model_init))
+
+def backend_params(model_init):
+    # Every argument bound to an init function, for the cache keys (hashed, never stored in clear).
+    # Raises TypeError when one of them is an object, see plain_value
+    if isinstance(model_init, partial):
+        return {"args": [plain_value(arg) for arg in model_init.args],
+                "keywords": {key: plain_value(value) for key, value in model_init.keywords.items()}}
+    return {}
+
+def make_key(model_name, prompt, params):
+    payload = json.dumps([model_name, prompt, params], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    # On-disk LLM response cache keyed by sha256(model name, prompt, generation params).
+    # SQLite in WAL mode lets several threads and processes read and write the same file;
+    # least recently used entries are evicted once the stored responses exceed max_bytes. The size of the cache is
+    # tracked as responses are written and only summed over the table when it goes past max_bytes or every
+    # check_every writes (other processes write to the same file)
+    def __init__(self, path, max_bytes=2 * 1024**3, timeout=60, check_every=1000):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.check_every = check_every
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            model_name TEXT,
+            response TEXT,
+            size INTEGER,
+            created REAL,
+            last_access REAL)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        conn.commit()
+        self.size = self._total(conn)
+
+    def _conn(self):
+        # sqlite3 connections cannot be shared across threads, keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute(f"PRAGMA busy_timeout={int(self.timeout * 1000)}")
+            self._local.conn = conn
+        return conn
+
+    def _total(self, conn):
+        return conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def _count(self, hit):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key):
+        conn = self._conn()
+        row = conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self._count(False)
+            return None
+        with conn:
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        self._count(True)
+        return row[0]
+
+    def put(self, key, response, model_name=None):
+        conn = self._conn()
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)", (key, model_name, response, size, now, now))
+            with self._stats_lock:
+                self.size += size
+                self.writes += 1
+                check = self.size > self.max_bytes or self.writes % self.check_every == 0
+            if check:
+                self._evict(conn)
+
+    def _evict(self, conn):
+        total = self._total(conn)
+        with self._stats_lock:
+            self.size = total
+        if total <= self.max_bytes:
+            return
+        # Drop the least recently used entries until the cache fits again
+        freed = 0
+        stale = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            if total - freed <= self.max_bytes:
+                break
+            stale.append((key,))
+            freed += size
+        conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+        with self._stats_lock:
+            self.size = total - freed
+
+    def wrap(self, call, model_name, **params):
+        # Cached version of a model call `call(input_txt, **kwargs)`, e.g. model_call or gen_txt_to_txt.
+        # params should hold every generation setting that changes the output (temperature, max tokens, ...), as plain values
+        params = {key: plain_value(value) for key, value in params.items()}
+        @wraps(call)
+        def cached_call(input_txt, **kwargs):
+            key = make_key(model_name, input_txt, params)
+            response = self.get(key)
+            if response is None:
+                response = call(input_txt, **kwargs)
+                self.put(key, response, model_name)
+            return response
+        return cached_call
+
+    def stats(self):
+        entries, total = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        with self._stats_lock:
+            self.size = total
+        calls = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / calls if calls else float("nan"),
+                "entries": entries,
+                "bytes": total}
+
+    def clear(self):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM responses")
+        with self._stats_lock:
+            self.size = 0
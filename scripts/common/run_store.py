@@ -0,0 +1,125 @@
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+import pandas as pd
+
+# Append-only checkpoint of a batch run, run_dir/records.jsonl: one line per completed unit of work (kind, key, record),
+# e.g. ("summary", patient, result of the summarizer) or ("fact_eval:gpt-4o", patient, judge answers).
+# Each line is flushed and fsynced when written, so a crash loses at most the work in flight, and reopening the
+# run directory restores every record (the last line for a key wins) so that finished work can be skipped.
+
+def plain_key(key):
+    # numpy / pandas scalars (DataFrame index values) as python values, so that keys survive the JSON round trip
+    return key.item() if hasattr(key, "item") else key
+
+def write_frame(df, path):
+    # Atomic write of a DataFrame as .parquet or pickle, readers never see a partial file
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    if path.suffix == ".parquet":
+        df.to_parquet(tmp_path)
+    else:
+        df.to_pickle(tmp_path)
+    os.replace(tmp_path, path)
+
+def read_frame(path):
+    path = Path(path)
+    return pd.read_parquet(path) if path.suffix == ".parquet" else pd.read_pickle(path)
+
+class FrameParts:
+    # Incremental output of a batch run: each write adds a part next to path (path.parts/part-00000.pkl, ...), written
+    # atomically, so the rows done so far are readable at any time and no row is written twice.
+    # consolidate writes the final DataFrame at path and removes the parts
+    def __init__(self, path):
+        self.path = Path(path)
+        self.directory = self.path.with_name(self.path.name + ".parts")
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        # Parts of an interrupted run are kept, a resumed run writes after them
+        self.next_part = len(self._parts())
+
+    def _parts(self):
+        return sorted(part for part in self.directory.glob("part-*") if part.suffix == self.path.suffix)
+
+    def write(self, df):
+        with self.lock:
+            part = self.next_part
+            self.next_part += 1
+        write_frame(df, self.directory / f"part-{part:05d}{self.path.suffix}")
+
+    def read(self):
+        # Rows of every part, the last part with a row wins
+        frames = [read_frame(part) for part in self._parts()]
+        if not frames:
+            return None
+        df = pd.concat(frames)
+        return df[~df.index.duplicated(keep="last")]
+
+    def consolidate(self, df):
+        write_frame(df, self.path)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+class RunStore:
+    def __init__(self, run_dir):
+        self.run_dir = Path(run_dir)
+        self.run_dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.run_dir / "records.jsonl"
+        self.lock = threading.Lock()
+        self.records = {}
+        if self.path.exists():
+            self._load()
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def _load(self):
+        with open(self.path, "rb") as f:
+            content = f.read()
+        # A crash in the middle of a write leaves a line without its newline: drop it before appending again
+        complete = content[:content.rfind(b"\n") + 1]
+        if len(complete) != len(content):
+            with open(self.path, "r+b") as f:
+                f.truncate(len(complete))
+        for line in complete.decode("utf-8").splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            self.records[(entry["kind"], entry["key"])] = entry["record"]
+
+    def append(self, kind, key, record):
+        key = plain_key(key)
+        line = json.dumps({"kind": kind, "key": key, "time": time.time(), "record": record}, default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.records[(kind, key)] = json.loads(line)["record"]
+
+    def get(self, kind, key, default=None):
+        return self.records.get((kind, plain_key(key)), default)
+
+    def is_done(self, kind, key):
+        # Records with an error are not done: they are run again on restart
+        record = self.get(kind, key)
+        return record is not None and not (isinstance(record, dict) and record.get("error") is not None)
+
+    def results(self, kind):
+        return {key: record for (record_kind, key), record in self.records.items() if record_kind == kind}
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def to_dataframe(self, kind):
+        # Records of one kind, one row per key (dict records as columns)
+        results = self.results(kind)
+        return pd.DataFrame(list(results.values()), index=list(results.keys()))
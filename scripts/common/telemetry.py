@@ -0,0 +1,128 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+import numpy as np
+import pandas as pd
+
+# Attributes (patient, stage, note_no, ...) of the model calls made in the current block, see telemetry_context
+call_context = contextvars.ContextVar("call_context", default={})
+
+@contextmanager
+def telemetry_context(**attrs):
+    # Tag every model call made inside the block, nested blocks add to (or override) the outer attributes.
+    # The block start is kept so that the time spent building the prompt before the call can be measured
+    token = call_context.set({**call_context.get(), **attrs, "_block_start": time.perf_counter()})
+    try:
+        yield
+    finally:
+        call_context.reset(token)
+
+@contextmanager
+def telemetry_queued():
+    # Marks the end of prompt building: time spent from here to the call is waiting for a backend slot
+    token = call_context.set({**call_context.get(), "_queued": time.perf_counter()})
+    try:
+        yield
+    finally:
+        call_context.reset(token)
+
+def with_context(fn):
+    # Run fn with the caller's telemetry attributes when it is executed on another thread (e.g. ThreadPoolExecutor.map)
+    parent = contextvars.copy_context()
+    return lambda *args: parent.copy().run(fn, *args)
+
+class Telemetry:
+    # Collects one event per model call: attributes of the enclosing telemetry_context blocks, prompt/response
+    # characters and tokens, time to build the prompt and to wait for a backend slot, latency, retries and errors
+    def __init__(self, count_tokens=None):
+        self.count_tokens = count_tokens
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    def wrap(self, call, backend=None):
+        @wraps(call)
+        def instrumented_call(input_txt, **kwargs):
+            attrs = call_context.get()
+            # Retries made below this wrapper (see resilience.py) are counted in _call_state
+            call_state = {"retries": 0}
+            token = call_context.set({**attrs, "_call_state": call_state})
+            start = time.perf_counter()
+            error = None
+            response = ""
+            try:
+                response = call(input_txt, **kwargs)
+                return response
+            except Exception as e:
+                error = repr(e)
+                raise
+            finally:
+                end = time.perf_counter()
+                call_context.reset(token)
+                event = {key: value for key, value in attrs.items() if not key.startswith("_")}
+                event.update({"backend": backend,
+                              "start_s": start - self.origin,
+                              "latency_s": end - start,
+                              "build_s": attrs.get("_queued", start) - attrs["_block_start"] if "_block_start" in attrs else None,
+                              "queue_s": start - attrs["_queued"] if "_queued" in attrs else None,
+                              "prompt_chars": len(input_txt),
+                              "response_chars": len(response),
+                              "prompt_tokens": self.count_tokens(input_txt) if self.count_tokens else None,
+                              "response_tokens": self.count_tokens(response) if self.count_tokens else None,
+                              "retries": attrs.get("retries", 0) + call_state["retries"],
+                              "error": error,
+                              "thread": threading.get_ident()})
+                with self.lock:
+                    self.events.append(event)
+        return instrumented_call
+
+    def to_dataframe(self):
+        with self.lock:
+            return pd.DataFrame(list(self.events))
+
+    def to_jsonl(self, path):
+        with self.lock, open(path, "w", encoding="utf-8") as f:
+            for event in self.events:
+                f.write(json.dumps(event, default=str) + "\n")
+
+    def to_chrome_trace(self, path):
+        # Open in chrome://tracing or https://ui.perfetto.dev, one row per thread
+        trace = []
+        with self.lock:
+            for event in self.events:
+                name = event.get("stage", "model_call")
+                if event.get("note_no") is not None:
+                    name = f"{name} #{event['note_no']}"
+                trace.append({"name": name, "cat": event.get("backend") or "llm", "ph": "X", "pid": os.getpid(), "tid": event["thread"],
+                              "ts": event["start_s"] * 1e6, "dur": event["latency_s"] * 1e6,
+                              "args": {key: value for key, value in event.items() if key not in ("start_s", "latency_s", "thread")}})
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f, default=str)
+
+    def summary(self, by="stage"):
+        # Per-stage table: calls, errors, retries, latency (total, p50, p99), prompt building and queueing time, sizes
+        events = self.to_dataframe()
+        if events.empty:
+            return events
+        if by not in events.columns:
+            events[by] = "model_call"
+        grouped = events.groupby(by, sort=False)
+        table = pd.DataFrame({"calls": grouped.size(),
+                              "errors": grouped["error"].count(),
+                              "retries": grouped["retries"].sum(),
+                              "latency_total_s": grouped["latency_s"].sum(),
+                              "latency_p50_s": grouped["latency_s"].median(),
+                              "latency_p99_s": grouped["latency_s"].agg(lambda x: np.percentile(x, 99)),
+                              "build_total_s": grouped["build_s"].sum(),
+                              "queue_total_s": grouped["queue_s"].sum(),
+                              "prompt_chars": grouped["prompt_chars"].sum(),
+                              "response_chars": grouped["response_chars"].sum()})
+        if self.count_tokens:
+            table["prompt_tokens"] = grouped["prompt_tokens"].sum()
+            table["response_tokens"] = grouped["response_tokens"].sum()
+        table["latency_share"] = table["latency_total_s"] / table["latency_total_s"].sum()
+        return table
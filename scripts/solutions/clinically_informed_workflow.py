@@ -1,44 +1,24 @@
-from vertexai.preview.generative_models import GenerativeModel
 import time 
 import pandas as pd
 import os
-
-hashes = "#####################"
-next_note = "---NEXT NOTE---"
-note_header = "UNJITTERED NOTE DATE"
-
-def simplify_dates(text, note_type):
-    real_start = text.find(note_header) + len(note_header)
-    real_h_p = note_type + text[real_start:]
-    return real_h_p.replace(hashes, "").strip()
-
-def extract_h_p(text):
-    # Find the first occurrence of multiple #
-    start = text.find(hashes) + len(hashes)
-    # Find the second occurrence
-    end = text.find(hashes, start)
-    # Return the content between them, stripped of whitespace
-    full_h_p = text[start:end].strip()
-    return simplify_dates(full_h_p, "H&P").strip()
-
-def extract_last_progress_note(text):
-    # Remember that the last note is the first one to be found in the text
-    
-    # Find first hash occurrence
-    first_hash = text.find(hashes)
-    # Find second hash occurrence
-    start = text.find(hashes, first_hash + len(hashes)) + len(hashes)
-    # Find next note marker
-    end = text.find(next_note, start)
-    full_last_note = text[start:end].strip()    
-    return  simplify_dates(full_last_note, "LAST PROGRESS NOTE").strip()
-
-def extract_other_progress_notes(text):    
-    # Select all progress notes except the first that appears in the text (the last by date)
-    other_progress_notes = text.split("---NEXT NOTE---")[1:]
-    # reverse the list to get the first note (by date) first in the list
-    other_progress_notes = other_progress_notes[::-1]
-    return [simplify_dates(note, "PROGRESS NOTE NO " + str(i+1)) for i, note in enumerate(other_progress_notes)]
+import sys
+import json
+import inspect
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from note_parser import parse_record
+# Moved to note_parser.py, still importable from here
+from note_parser import simplify_dates, extract_h_p, extract_last_progress_note, extract_other_progress_notes
+from prompt_budget import TokenBudget
+from note_dedup import dedup_notes
+from note_scheduler import draft_change
+sys.path.append(str(Path(__file__).resolve().parents[1] / "common"))
+from response_cache import ResponseCache
+from run_store import RunStore, FrameParts
+from resilience import resilient_pair
+from backends import vertex_init, vertex_call
+from telemetry import Telemetry, telemetry_context, telemetry_queued, with_context
 
 content = """Format 1: Standard Section-Based Summary:
 First, provide the summary organized into the following numbered sections:
@@ -83,7 +63,7 @@ Requirements:
 - Acronyms: Avoid acronyms unless they are standard in medical documentation (e.g., ECG).
 """
 
-def make_prompt_1(example_input):
+def format_prompt_1(h_p, last_note):
     prompt = f"""
 Role: You are an expert AI assistant specializing in internal medicine and medical documentation. Your task is to read the following first (History & Physical) and last progress note from a patient's hospital stay and to generate a concise, professional "Hospital Course Summary" for that patient.
 
@@ -92,16 +72,23 @@ Output Format: You are required to provide the Hospital Course Summary in two di
 
 ---
 Patient History and Physical (H&P):
-{extract_h_p(example_input)}
+{h_p}
 ---
 Patient last Progress Note:
-{extract_last_progress_note(example_input)}
+{last_note}
 ---
 Provide your "Hospital Course Summary" for the patient below following the guidelines and output format requirements.
 """
     return prompt
 
-def make_prompt_2(example_input, draft, note_no):
+def make_prompt_1(example_input, budget=None):
+    # With a TokenBudget, the H&P and the last note are cut to fit (see TokenBudget.pack_h_p_last)
+    if budget is None:
+        record = parse_record(example_input)
+        return format_prompt_1(record.h_p(), record.last_progress_note())
+    return format_prompt_1(*budget.pack_h_p_last(example_input, budget.count_tokens(format_prompt_1("", ""))))
+
+def format_prompt_2(draft, note):
     prompt = f"""
 Role: You are an expert AI assistant specializing in internal medicine and medical documentation. Your task is to read the following medical record notes from a patient's hospital stay and create a concise yet comprehensive Hospital Course Summary for a patient
 
@@ -115,13 +102,89 @@ Your Draft "Hospital Course Summary":
 
 Extra Information from Other Progress Notes:
 ---
-{extract_other_progress_notes(example_input)[note_no]}
+{note}
 ---
 Provide Your Improved "Hospital Course Summary" for the patient below following the guidelines and output format requirements.
 """
     return prompt
 
-def make_prompt_3(example_input, draft):
+def make_prompt_2(example_input, draft, note_no, budget=None, note=None, retriever=None):
+    # note_no="last" refines the draft with the last progress note (used when resuming a chain on newer notes),
+    # note replaces the text of the note (e.g. only its new paragraphs, see note_dedup.py)
+    record = parse_record(example_input)
+    if note is None:
+        note = record.last_progress_note() if note_no == "last" else record.progress_note(note_no)
+    if retriever is not None:
+        # Only the paragraphs relevant to the sections of the summary
+        note = retriever.note_excerpt(example_input, note)
+    if budget is not None:
+        # Cut the end of a note that would not fit in the budget with the rest of the prompt
+        note = budget.truncate(note, budget.prompt_tokens - budget.count_tokens(format_prompt_2(draft, "")))
+    return format_prompt_2(draft, note)
+
+def format_prompt_map(notes):
+    prompt = f"""
+Role: You are an expert AI assistant specializing in internal medicine and medical documentation. Your task is to read the following notes, covering one period of a patient's hospital stay, and to generate a concise, professional "Hospital Course Summary" of that period.
+
+Output Format: You are required to provide the Hospital Course Summary in two distinct formats, followed by a concluding paragraph. Please ensure you provide both formats in the order specified below. Leave a section empty when the notes do not document it:
+{content_and_requirements}
+
+---
+Patient Notes for this period:
+{"\n\n".join(notes)}
+---
+Provide your "Hospital Course Summary" of this period below following the guidelines and output format requirements.
+"""
+    return prompt
+
+def make_prompt_map(example_input, note_nos, budget=None):
+    # note_nos: progress note numbers, "h_p" or "last". With a TokenBudget, notes that would not fit are cut to an
+    # equal share of the room left (see fit_map_groups to split a group instead)
+    record = parse_record(example_input)
+    notes = [record.h_p() if note_no == "h_p" else record.last_progress_note() if note_no == "last" else record.progress_note(note_no)
+             for note_no in note_nos]
+    if budget is not None:
+        available = budget.prompt_tokens - budget.count_tokens(format_prompt_map([]))
+        # +2 for the blank line joining the notes
+        if sum(budget.count_tokens(note) + 2 for note in notes) > available:
+            notes = [budget.truncate(note, available // len(notes) - 2) for note in notes]
+    return format_prompt_map(notes)
+
+def fit_map_groups(example_input, groups, budget):
+    # Groups of notes whose map prompt fits the budget, in date order: a group too long is halved, then its halves, ...
+    # A single note too long is cut by make_prompt_map
+    fitted = []
+    pending = list(groups)
+    while pending:
+        group = pending.pop(0)
+        if len(group) > 1 and budget.count_tokens(make_prompt_map(example_input, group)) > budget.prompt_tokens:
+            pending[:0] = [group[:len(group) // 2], group[len(group) // 2:]]
+        else:
+            fitted.append(group)
+    return fitted
+
+def make_prompt_merge(earlier_draft, later_draft):
+    prompt = f"""
+Role: You are an expert AI assistant specializing in internal medicine and medical documentation. Your task is to merge two partial Hospital Course Summaries of the same patient's hospital stay into a single concise yet comprehensive Hospital Course Summary.
+
+The first summary covers an earlier period of the stay than the second one. Keep every relevant detail from both, present events in chronological order, and when the two summaries disagree, prefer the later one for the patient's current status.
+
+Output Format: You are required to provide the Hospital Course Summary in two distinct formats, followed by a concluding paragraph. Please ensure you provide both formats in the order specified below:
+{content_and_requirements}
+
+Summary of the earlier period:
+---
+{earlier_draft}
+---
+Summary of the later period:
+---
+{later_draft}
+---
+Provide Your Merged "Hospital Course Summary" for the patient below following the guidelines and output format requirements.
+"""
+    return prompt
+
+def format_prompt_3(draft, h_p, progress_notes, last_note):
     prompt = f"""
 Role: You are an expert AI assistant specializing in internal medicine and medical documentation. Your primary function is to meticulously refine Hospital Course Summaries to ensure they are accurate, comprehensive within the confines of the provided records, and clinically relevant. You operate strictly based on the provided patient medical records and must not introduce external knowledge or make inferences.
 
@@ -136,18 +199,15 @@ Task: You will receive a first-draft Hospital Course Summary and the complete se
 Output Format: You are required to provide the Hospital Course Summary in two distinct formats, followed by a concluding paragraph. Please ensure you provide both formats in the order specified below:
 {content_and_requirements}
 
-Your Draft "Hospital Course Summary":
-{draft}
-
 Input:
 - Your Draft "Hospital Course Summary":
 {draft}
 
 - Entire sequence of notes for that patient: 
 ---
-{extract_h_p(example_input)}
-{"\n\n".join(extract_other_progress_notes(example_input))}
-\n\n{extract_last_progress_note(example_input)}
+{h_p}
+{"\n\n".join(progress_notes)}
+\n\n{last_note}
 ---
 
 Output:
@@ -155,75 +215,383 @@ Provide Your Improved "Hospital Course Summary" for the patient below following
 """
     return prompt
 
+def make_prompt_3(example_input, draft, budget=None, report=None, retriever=None):
+    # With a TokenBudget, notes are packed by priority (H&P, last note, most recent notes first) and
+    # the tokens used by each section are written to the report dict if one is given.
+    # With a NoteRetriever, only the paragraphs retrieved for the sections and the claims of the draft are included,
+    # packed the same way with a budget
+    if retriever is not None:
+        h_p, progress_notes, last_note = retriever.evidence(example_input, draft, report)
+    else:
+        record = parse_record(example_input)
+        h_p, progress_notes, last_note = record.h_p(), record.other_progress_notes(), record.last_progress_note()
+    if budget is None:
+        return format_prompt_3(draft, h_p, progress_notes, last_note)
+    fixed_tokens = budget.count_tokens(format_prompt_3(draft, "", [], ""))
+    h_p, progress_notes, last_note, sections = budget.pack_texts(h_p, progress_notes, last_note, fixed_tokens)
+    if report is not None:
+        report.update(sections)
+    return format_prompt_3(draft, h_p, progress_notes, last_note)
+
 def model_init():
-    # Overwrite this function to use another model
+    # Overwrite this function to use another model (or use a registered one, see backends.get_backend).
+    # vertexai is imported here, on first use, not with this module
     model_name="gemini-2.0-flash-exp"
-    return {"loaded_model": GenerativeModel(model_name)}
+    return vertex_init(model_name)
 
 def model_call(input_txt, **kwargs):
     # Overwrite this function to use another model
-    ready_model = kwargs["loaded_model"]
-    response = ready_model.generate_content([input_txt])
-    return response.candidates[0].content.parts[0].text    
+    return vertex_call(input_txt, **kwargs)    
 
-def generate_summary(gen_txt_to_txt, example_input):
+def refine_adaptive(gen_txt_to_txt, example_input, draft, notes, scheduler, budget=None, report=None, retriever=None):
+    # Chain refinement in the order planned by a NoteScheduler, notes being {note_no: text}. Notes sent together are
+    # labelled "notes 2+5" in the drafts; skipped notes get a (label, None) entry: "note 3 skipped (converged)" when the
+    # chain stopped before them, "note 4 skipped (redundant)" when they were predicted to bring nothing new
+    steps, skipped, gains = scheduler.plan(example_input, notes)
+    drafts = []
+    changes = []
+    for step_i, note_nos in enumerate(steps):
+        if scheduler.converged(changes):
+            drafts += [(f"note {note_no+1} skipped (converged)", None) for later in steps[step_i:] for note_no in later]
+            break
+        label = note_nos[0] + 1 if len(note_nos) == 1 else "notes " + "+".join(str(note_no + 1) for note_no in note_nos)
+        with telemetry_context(stage="make_prompt_2", note_no=label):
+            new_draft = gen_txt_to_txt(make_prompt_2(example_input, draft, note_nos[0], budget, "\n\n".join(notes[note_no] for note_no in note_nos), retriever))
+        changes.append(draft_change(draft, new_draft))
+        draft = new_draft
+        drafts.append((label, draft))
+    drafts += [(f"note {note_no+1} skipped (redundant)", None) for note_no in skipped]
+    if report is not None:
+        report["schedule"] = {"notes": len(notes), "calls": len(changes), "calls_saved": len(notes) - len(changes),
+                              "merged": [[note_no + 1 for note_no in note_nos] for note_nos in steps if len(note_nos) > 1],
+                              "skipped": [label for label, draft in drafts if draft is None],
+                              "predicted_new_shingles": {note_no + 1: gain for note_no, gain in gains.items()},
+                              "draft_changes": changes}
+    return drafts, draft
+
+def generate_summary(gen_txt_to_txt, example_input, budget=None, report=None, dedup=False, scheduler=None, retriever=None):
     drafts = []
     
     # generate first draft
-    previous_draft = gen_txt_to_txt(make_prompt_1(example_input))
+    with telemetry_context(stage="make_prompt_1", note_no=0):
+        previous_draft = gen_txt_to_txt(make_prompt_1(example_input, budget))
     drafts.append((0, previous_draft))
 
-    # generate improved drafts by iteratively incorporating details from progress notes 1,2,3, ... not including the last note
-    no_of_notes = len(extract_other_progress_notes(example_input))
-    for i in range(no_of_notes):
-        previous_draft = gen_txt_to_txt(make_prompt_2(example_input, previous_draft, i))
-        drafts.append((i+1, previous_draft))
+    # with dedup, near-duplicate notes are skipped and copied-forward paragraphs are left out of the others
+    no_of_notes = parse_record(example_input).no_of_other_notes
+    if dedup:
+        plan, dedup_report = dedup_notes(example_input)
+        if report is not None:
+            report["dedup"] = dedup_report
+    else:
+        plan = [(i, None) for i in range(no_of_notes)]
+
+    if scheduler is not None:
+        # refine with the most informative notes first, until the drafts stop changing
+        record = parse_record(example_input)
+        notes = {i: note if note is not None else record.progress_note(i) for i, note in plan if not (dedup and note is None)}
+        refined, previous_draft = refine_adaptive(gen_txt_to_txt, example_input, previous_draft, notes, scheduler, budget, report, retriever)
+        drafts += refined
+    else:
+        # generate improved drafts by iteratively incorporating details from progress notes 1,2,3, ... not including the last note
+        for i, note in plan:
+            if dedup and note is None:
+                continue
+            with telemetry_context(stage="make_prompt_2", note_no=i+1):
+                previous_draft = gen_txt_to_txt(make_prompt_2(example_input, previous_draft, i, budget, note, retriever))
+            drafts.append((i+1, previous_draft))
         
-    final_draft = gen_txt_to_txt(make_prompt_3(example_input, previous_draft))
+    with telemetry_context(stage="make_prompt_3"):
+        final_draft = gen_txt_to_txt(make_prompt_3(example_input, previous_draft, budget, report, retriever))
     return drafts, final_draft
 
+def generate_summary_incremental(gen_txt_to_txt, example_input, chain_state=None, budget=None, report=None, retriever=None):
+    # Same chain as generate_summary, but resumed from chain_state, the state returned by a previous call on an
+    # earlier version of the same stay: only the notes that no valid draft has consumed yet go through make_prompt_2
+    record = parse_record(example_input)
+    h_p_fp, last_fp = record.fingerprint(which="h_p"), record.fingerprint(which="last")
+    other_fps = [record.fingerprint(i) for i in range(record.no_of_other_notes)]
+    available = set(other_fps) | {h_p_fp, last_fp}
+
+    # Keep the longest prefix of drafts built only from notes that are still in the record, unchanged
+    steps = []
+    for step in (chain_state or {}).get("steps", []):
+        if not all(fp in available for fp in step["fingerprints"]):
+            break
+        steps.append(step)
+    reused_steps = len(steps)
+
+    # generate first draft
+    if not steps:
+        with telemetry_context(stage="make_prompt_1", note_no=0):
+            steps.append({"fingerprints": [h_p_fp, last_fp], "draft": gen_txt_to_txt(make_prompt_1(example_input, budget))})
+    previous_draft = steps[-1]["draft"]
+
+    # refine with the notes not consumed yet in date order, the last note included when it is new
+    consumed = {fp for step in steps for fp in step["fingerprints"]}
+    pending = [(fp, i) for i, fp in enumerate(other_fps) if fp not in consumed]
+    if last_fp not in consumed:
+        pending.append((last_fp, "last"))
+    for fp, note_no in pending:
+        with telemetry_context(stage="make_prompt_2", note_no=note_no if note_no == "last" else note_no+1):
+            previous_draft = gen_txt_to_txt(make_prompt_2(example_input, previous_draft, note_no, budget, retriever=retriever))
+        steps.append({"fingerprints": [fp], "draft": previous_draft})
+
+    with telemetry_context(stage="make_prompt_3"):
+        final_draft = gen_txt_to_txt(make_prompt_3(example_input, previous_draft, budget, report, retriever))
+    drafts = [(i, step["draft"]) for i, step in enumerate(steps)]
+    return drafts, final_draft, {"steps": steps, "reused_steps": reused_steps}
+
+def generate_summary_tree(gen_txt_to_txt, example_input, notes_per_group=4, max_workers=8, budget=None, report=None, retriever=None):
+    # Map/merge alternative to generate_summary: groups of notes are summarized in parallel,
+    # then partial summaries are merged pairwise, giving O(log N) sequential calls instead of O(N)
+    no_of_notes = parse_record(example_input).no_of_other_notes
+    groups = [list(range(i, min(i + notes_per_group, no_of_notes))) for i in range(0, no_of_notes, notes_per_group)]
+    if budget is not None:
+        groups = fit_map_groups(example_input, groups, budget)
+    labels = [f"notes {group[0]+1}-{group[-1]+1}" if len(group) > 1 else f"note {group[0]+1}" for group in groups]
+    drafts = []
+
+    def map_step(job):
+        label, group = job
+        with telemetry_context(stage="make_prompt_map", note_no=label):
+            return gen_txt_to_txt(make_prompt_map(example_input, group, budget))
+
+    def merge_step(job):
+        label, pair = job
+        if len(pair) == 1:
+            return pair[0]
+        with telemetry_context(stage="make_prompt_merge", note_no=label):
+            return gen_txt_to_txt(make_prompt_merge(*pair))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # map: one draft for the H&P, one per group of progress notes 1,2,3, ... and one for the last note
+        jobs = [("H&P", ["h_p"])] + list(zip(labels, groups)) + [("last note", ["last"])]
+        level = list(executor.map(with_context(map_step), jobs))
+        drafts.append((0, level[0]))
+        drafts += [(label, draft) for (label, _), draft in zip(jobs[1:], level[1:])]
+
+        # merge: leaves in date order, so the last note is always on the later side and sets the status at discharge
+        depth = 0
+        while len(level) > 1:
+            depth += 1
+            jobs = [(f"merge {depth}.{i//2+1}", level[i:i+2]) for i in range(0, len(level), 2)]
+            merged = list(executor.map(with_context(merge_step), jobs))
+            drafts += [(label, draft) for (label, pair), draft in zip(jobs, merged) if len(pair) == 2]
+            level = merged
+
+    with telemetry_context(stage="make_prompt_3"):
+        final_draft = gen_txt_to_txt(make_prompt_3(example_input, level[0], budget, report, retriever))
+    return drafts, final_draft
+
+summary_strategies = ("chain", "tree")
+
+# One semaphore per backend (model_call) and max_concurrency, shared by every DC_summarizer using both
+backend_semaphores = {}
+backend_semaphores_lock = threading.Lock()
+
+def get_backend_semaphore(backend, max_concurrency):
+    # Wrapped calls (e.g. cached ones) share the semaphore of the call they wrap. A DC_summarizer asking for another
+    # max_concurrency gets its own semaphore instead of the limit of the first caller
+    key = (inspect.unwrap(backend), max_concurrency)
+    with backend_semaphores_lock:
+        if key not in backend_semaphores:
+            backend_semaphores[key] = threading.BoundedSemaphore(max_concurrency)
+        return backend_semaphores[key]
+
 class DC_summarizer:
-    def __init__(self, model_init, model_call):
+    def __init__(self, model_init, model_call, max_concurrency=8, strategy="chain", notes_per_group=4, budget=None, state_dir=None, dedup=False, telemetry=None, scheduler=None, retriever=None):
+        if strategy not in summary_strategies:
+            raise ValueError(f"strategy must be one of {summary_strategies}, got {strategy!r}")
         self.model_init = model_init
-        self.model_call = model_call
         self.model_init_dict = model_init()
+        # Maximum number of simultaneous calls to this backend
+        self.backend_semaphore = get_backend_semaphore(model_call, max_concurrency)
+        # Optional Telemetry: one event per model call with its stage, note, sizes and timings
+        self.telemetry = telemetry
+        self.model_call = telemetry.wrap(model_call, getattr(inspect.unwrap(model_call), "__qualname__", None)) if telemetry is not None else model_call
+        # "chain" refines one draft note by note, "tree" summarizes groups of notes_per_group notes in parallel and merges them
+        self.strategy = strategy
+        self.notes_per_group = notes_per_group
+        # Optional TokenBudget: prompts are packed to fit the model and oversized ones are refused before being sent
+        self.budget = budget
+        # Skip near-duplicate progress notes and copied-forward paragraphs in the chain strategy (see note_dedup.py)
+        self.dedup = dedup
+        # Optional NoteScheduler: most informative notes first, low-novelty ones merged or skipped, early exit (chain strategy)
+        self.scheduler = scheduler
+        # Optional NoteRetriever: prompts hold the paragraphs retrieved for each section / claim instead of the full notes
+        self.retriever = retriever
+        # Draft chains by patient_id, kept in memory and, when state_dir is set, on disk to resume across runs
+        self.state_dir = Path(state_dir) if state_dir is not None else None
+        self.chain_states = {}
         
     def _gen_txt_to_txt(self, input_txt):
-        return self.model_call(input_txt, **self.model_init_dict)
-
-    def summarize(self, example_input, verbose=True):
+        if self.budget is not None:
+            self.budget.check(input_txt)
+        with telemetry_queued(), self.backend_semaphore:
+            return self.model_call(input_txt, **self.model_init_dict)
+
+    def _generate_summary(self, example_input, report=None):
+        if self.strategy == "tree":
+            return generate_summary_tree(self._gen_txt_to_txt, example_input, self.notes_per_group, budget=self.budget, report=report, retriever=self.retriever)
+        return generate_summary(self._gen_txt_to_txt, example_input, self.budget, report, self.dedup, self.scheduler, self.retriever)
+
+    def _load_chain_state(self, patient_id):
+        if patient_id not in self.chain_states and self.state_dir is not None:
+            state_path = self.state_dir / f"{patient_id}.json"
+            if state_path.exists():
+                with open(state_path, 'r', encoding='utf-8') as f:
+                    self.chain_states[patient_id] = json.load(f)
+        return self.chain_states.get(patient_id)
+
+    def _save_chain_state(self, patient_id, chain_state):
+        self.chain_states[patient_id] = chain_state
+        if self.state_dir is not None:
+            self.state_dir.mkdir(parents=True, exist_ok=True)
+            state_path = self.state_dir / f"{patient_id}.json"
+            tmp_path = state_path.with_suffix(".json.tmp")
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(chain_state, f)
+            os.replace(tmp_path, state_path)
+
+    def summarize(self, example_input, verbose=True, patient_id=None):
+        # With a patient_id, the chain resumes from the drafts of the previous call for that patient (see generate_summary_incremental)
         self.example_input = example_input
-        self.no_of_notes = 2+len(extract_other_progress_notes(example_input))
+        self.no_of_notes = parse_record(example_input).no_of_notes
         if verbose:
             print(f"""A total of {self.no_of_notes} notes need to be summarized for this patient.""")
         start = time.time()
-        self.drafts, self.final_draft = generate_summary(self._gen_txt_to_txt, example_input)
+        # Tokens used by each section of the final make_prompt_3 prompt (when a budget is set)
+        self.prompt_report = {}
+        if patient_id is None:
+            with telemetry_context(patient=None):
+                self.drafts, self.final_draft = self._generate_summary(example_input, self.prompt_report)
+        else:
+            # The resumed chain refines with every new note in date order: no reordering, merging or skipping of notes
+            if self.strategy != "chain":
+                raise ValueError("Incremental summarization (patient_id) requires the chain strategy")
+            if self.scheduler is not None or self.dedup:
+                raise ValueError("Incremental summarization (patient_id) does not support scheduler or dedup")
+            with telemetry_context(patient=patient_id):
+                self.drafts, self.final_draft, chain_state = generate_summary_incremental(self._gen_txt_to_txt, example_input, self._load_chain_state(patient_id), self.budget, self.prompt_report, self.retriever)
+            self._save_chain_state(patient_id, chain_state)
+            self.reused_drafts = chain_state["reused_steps"]
+            if verbose:
+                print(f"""Resumed from {self.reused_drafts} existing drafts, {len(self.drafts) - self.reused_drafts} new drafts generated.""")
         end = time.time()
         self.time_to_summarize = end - start # in seconds
+
+    def _summarize_one(self, patient, example_input):
+        # Calls for one patient keep the order of the strategy: each draft depends on the previous one(s)
+        start = time.time()
+        prompt_report = {}
+        try:
+            with telemetry_context(patient=patient):
+                drafts, final_draft = self._generate_summary(example_input, prompt_report)
+            error = None
+        except Exception as e:
+            drafts, final_draft, error = [], None, repr(e)
+        end = time.time()
+        return {"predicted_brief_hospital_course": final_draft, "drafts": drafts, "time_to_summarize": end - start, "prompt_report": prompt_report, "error": error}
+
+    def summarize_many(self, df, max_workers=16, verbose=True, run_store=None, submission_path=None, flush_every=16):
+        # Summarize every patient in df["inputs"] concurrently, the backend semaphore caps in-flight calls.
+        # With a RunStore, each patient is checkpointed as soon as it is done and patients already done in the store
+        # are not summarized again (failed ones are retried). With submission_path (.pkl or .parquet), the patients done
+        # are written flush_every at a time as parts next to it (see FrameParts), and the full submission at the end
+        inputs = df["inputs"].tolist()
+        finished = {}
+        if run_store is not None:
+            finished = {i: run_store.get("summary", patient) for i, patient in enumerate(df.index) if run_store.is_done("summary", patient)}
+        todo = [i for i in range(len(inputs)) if i not in finished]
+        if verbose:
+            print(f"""Summarizing {len(todo)} patients with up to {max_workers} patients in flight ({len(finished)} already done).""")
+        finished_lock = threading.Lock()
+        parts = FrameParts(submission_path) if submission_path is not None else None
+        unflushed = []
+        def run(i):
+            result = self._summarize_one(df.index[i], inputs[i])
+            if run_store is not None:
+                run_store.append("summary", df.index[i], result)
+            with finished_lock:
+                finished[i] = result
+                unflushed.append(i)
+                flush = unflushed[:] if parts is not None and len(unflushed) >= flush_every else []
+                if flush:
+                    unflushed.clear()
+            # Only the new rows are written, outside the lock
+            if flush:
+                parts.write(self._submission_frame(df, {j: finished[j] for j in flush}))
+            return result
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(run, todo))
+        end = time.time()
+        self.time_to_summarize_many = end - start # in seconds
+        self.batch_results = pd.DataFrame([finished[i] for i in range(len(inputs))], index=df.index)
+        self.batch_results.insert(0, "inputs", inputs)
+        if parts is not None:
+            parts.consolidate(self.submission())
+        if verbose:
+            print(f"""{self.batch_results["error"].notna().sum()} patients failed, total time {self.time_to_summarize_many:.0f}s.""")
+        return self.batch_results
+
+    def _submission_frame(self, df, finished):
+        done = sorted(finished)
+        return pd.DataFrame({"inputs": [df["inputs"].iloc[i] for i in done],
+                             "predicted_brief_hospital_course": [finished[i]["predicted_brief_hospital_course"] for i in done]},
+                            index=df.index[done])
+
+    def submission(self):
+        # Columns expected by the benchmark submission folder
+        return self.batch_results[["inputs", "predicted_brief_hospital_course"]]
     
 if __name__ == "__main__":
     # For HIPAA compliance, everything remains in our Google Cloud Project
     os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = '../../mykeys/grolleau_application_default_credentials.json'
     os.environ['GCLOUD_PROJECT'] = 'som-nero-phi-jonc101'
     
-    # Load the trainset
-    trainset = pd.read_pickle('../../pickle/train_test_dfs/trainset.pkl')
+    # Load the trainset (memory-mapped Arrow copy of the pickle, created on first use)
+    from dataset_store import open_dataset
+    trainset = open_dataset('../../pickle/train_test_dfs/trainset.pkl')
     
     # Select an example input
     ex_i = 15
-    example_input = trainset["inputs"].iloc[ex_i]
+    example_row = trainset.row(ex_i)
+    example_input = example_row["inputs"]
     
     # Print the example input (physician's H&P and progress notes)
     print(example_input)
     
+    # Cache responses on disk so that reruns only pay for prompts that changed
+    response_cache = ResponseCache('../../cache/llm_responses.sqlite')
+    
+    # Stay under the Vertex AI quotas, retry transient errors and hedge the slowest calls
+    gemini_init, gemini_call = resilient_pair(model_init, model_call, "gemini-2.0-flash-exp", requests_per_minute=200, tokens_per_minute=4_000_000,
+                                              count_tokens=TokenBudget("gemini-2.0-flash-exp").count_tokens, hedge_after=60)
+    
     # Instantiate the DC_summarizer class
-    DC_summary_example = DC_summarizer(model_init, model_call)
+    # Record every model call to see where the time goes
+    telemetry = Telemetry(count_tokens=TokenBudget("gemini-2.0-flash-exp").count_tokens)
+    DC_summary_example = DC_summarizer(gemini_init, response_cache.wrap(gemini_call, "gemini-2.0-flash-exp"), budget=TokenBudget("gemini-2.0-flash-exp"), telemetry=telemetry)
     
     # Generate the drafts and final draft
     DC_summary_example.summarize(example_input)
 
     # Print the final draft
     print(DC_summary_example.final_draft)
+    print(DC_summary_example.prompt_report)
+    print(response_cache.stats())
+    print(gemini_call.resilience.stats)
+    print(telemetry.summary())
+    telemetry.to_chrome_trace('../../cache/summarize_trace.json')
     
     # Compare to the physician's summary
-    print(trainset["brief_hospital_course"].iloc[ex_i])
\ No newline at end of file
+    print(example_row["brief_hospital_course"])
+    
+    # python clinically_informed_workflow.py --submit-testset: summarize the 200 test set patients for a submission.
+    # The batch run is resumable: after a crash, rerunning only summarizes the patients that are not in the run store yet
+    if "--submit-testset" in sys.argv:
+        testset = open_dataset('../../pickle/train_test_dfs/testset.pkl')
+        with RunStore('../../cache/runs/testset_gemini') as run_store:
+            DC_summary_example.summarize_many(testset.to_pandas(), run_store=run_store, submission_path='../../cache/runs/testset_gemini/submission.pkl')
\ No newline at end of file
@@ -0,0 +1,168 @@
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+import pyarrow as pa
+from note_parser import parse_record
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# A converted dataset is a directory with two uncompressed Arrow IPC files, memory-mapped when opened:
+# - patients.arrow: one row per patient, every column and the index of the pickle plus patient_i, note_offset, note_count
+# - notes.arrow: one row per note (patient_i, note_no, label, date, start, end), start/end being offsets in inputs
+# - source.json: size and mtime of the pickle it was converted from, a store older than its pickle is converted again
+# Rows are written in batches of batch_size patients, so reading a patient only pages in its batch.
+# A conversion writes a temporary directory renamed into place once complete: a crash never leaves a partial store.
+# Workers opening the same pickle convert it once, the others wait on a lock file next to the store.
+
+# Columns added to the pickle's, and the version of the layout (a store in an older layout is converted again)
+store_columns = ("patient_i", "note_offset", "note_count")
+store_format = 2
+
+def note_rows(patient_i, inputs):
+    # Notes in date order: H&P, progress notes 1,2,3, ..., last progress note
+    record = parse_record(inputs)
+    rows = [(record.h_p_date, "H&P", record.h_p_span)]
+    rows += [(date, f"PROGRESS NOTE NO {i+1}", span) for i, (date, span) in enumerate(zip(record.note_dates, record.note_spans))]
+    rows.append((record.last_note_date, "LAST PROGRESS NOTE", record.last_note_span))
+    return [{"patient_i": patient_i, "note_no": note_no, "label": label, "date": date, "start": start, "end": end}
+            for note_no, (date, label, span) in enumerate(rows) for start, end in [record._span_bounds(span)]]
+
+def write_ipc(path, table, batch_size):
+    with pa.OSFile(str(path), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=batch_size)
+
+def pickle_source(pickle_path):
+    stat = Path(pickle_path).stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "format": store_format}
+
+def replace_dir(tmp_dir, store_dir):
+    # Rename tmp_dir to store_dir, the previous store (if any) being moved aside first and then removed.
+    # Processes that memory-mapped the previous files keep reading them
+    old_dir = store_dir.with_name(f"{store_dir.name}.old-{os.getpid()}")
+    if store_dir.exists():
+        os.replace(store_dir, old_dir)
+    try:
+        os.replace(tmp_dir, store_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+@contextmanager
+def conversion_lock(store_dir):
+    # Exclusive lock on store_dir.lock, released when the file is closed or the process dies.
+    # Without fcntl (Windows) no lock is taken, see open_dataset
+    lock_path = store_dir.with_name(f"{store_dir.name}.lock")
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def convert_dataframe(df, store_dir, batch_size=64, source=None):
+    # source: written to source.json, see is_stale
+    store_dir = Path(store_dir)
+    store_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = store_dir.with_name(f"{store_dir.name}.tmp-{os.getpid()}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    clashes = [name for name in store_columns if name in df.columns or name in df.index.names]
+    if clashes:
+        raise ValueError(f"The dataframe already has columns named {clashes}, reserved by the store")
+    tmp_dir.mkdir()
+    notes = []
+    patients = {"patient_i": list(range(len(df))), "note_offset": [], "note_count": []}
+    for patient_i, inputs in enumerate(df["inputs"].tolist()):
+        rows = note_rows(patient_i, inputs)
+        patients["note_offset"].append(len(notes))
+        patients["note_count"].append(len(rows))
+        notes += rows
+    notes_schema = pa.schema([("patient_i", pa.int32()), ("note_no", pa.int32()), ("label", pa.string()),
+                              ("date", pa.timestamp("s")), ("start", pa.int64()), ("end", pa.int64())])
+    # Every column and the index of the dataframe, restored by DatasetStore.to_pandas through the pandas metadata
+    patients_table = pa.Table.from_pandas(df, preserve_index=True)
+    for key in ("inputs", "brief_hospital_course"):
+        # large_string: the notes of all patients together can go past the 2GB offsets of pa.string()
+        if key in patients_table.column_names:
+            patients_table = patients_table.set_column(patients_table.column_names.index(key), key, patients_table[key].cast(pa.large_string()))
+    for key, values in patients.items():
+        patients_table = patients_table.append_column(key, pa.array(values, type=pa.int64()))
+    write_ipc(tmp_dir / "patients.arrow", patients_table, batch_size)
+    write_ipc(tmp_dir / "notes.arrow", pa.Table.from_pylist(notes, schema=notes_schema), batch_size * 32)
+    with open(tmp_dir / "source.json", "w", encoding="utf-8") as f:
+        json.dump(source or {}, f)
+    replace_dir(tmp_dir, store_dir)
+    return store_dir
+
+def convert_pickle(pickle_path, store_dir=None, batch_size=64):
+    import pandas as pd
+    pickle_path = Path(pickle_path)
+    store_dir = store_dir if store_dir is not None else pickle_path.with_suffix(".arrow")
+    source = pickle_source(pickle_path)
+    return convert_dataframe(pd.read_pickle(pickle_path), store_dir, batch_size, source)
+
+def is_stale(store_dir, pickle_path):
+    # True when the store is missing, incomplete or converted from another version of the pickle
+    try:
+        with open(Path(store_dir) / "source.json", "r", encoding="utf-8") as f:
+            source = json.load(f)
+    except (OSError, ValueError):
+        return True
+    return source != pickle_source(pickle_path)
+
+class DatasetStore:
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+        # Memory-mapped and zero-copy: nothing is read from disk until a patient is accessed
+        self.patients = pa.ipc.open_file(pa.memory_map(str(self.store_dir / "patients.arrow"))).read_all()
+        self.notes_table = pa.ipc.open_file(pa.memory_map(str(self.store_dir / "notes.arrow"))).read_all()
+        self.columns = self.patients.column_names
+        # Columns holding the pickle's index, and the pickle's own columns
+        pandas_metadata = json.loads((self.patients.schema.metadata or {}).get(b"pandas", b"{}"))
+        self.index_columns = [name for name in pandas_metadata.get("index_columns", []) if isinstance(name, str)]
+        self.source_columns = [name for name in self.columns if name not in store_columns and name not in self.index_columns]
+
+    def __len__(self):
+        return self.patients.num_rows
+
+    def row(self, patient_i):
+        # One patient as a dict of python values (inputs, brief_hospital_course, ..., the index under its column name)
+        return {key: values[0] for key, values in self.patients.slice(patient_i, 1).to_pydict().items()}
+
+    def notes(self, patient_i):
+        # Note rows of one patient, in date order
+        row = self.patients.slice(patient_i, 1)
+        offset, count = row["note_offset"][0].as_py(), row["note_count"][0].as_py()
+        return self.notes_table.slice(offset, count).to_pylist()
+
+    def iter_patients(self, patient_is=None):
+        # Stream patients one at a time, e.g. the shard of a worker
+        patient_is = range(len(self)) if patient_is is None else patient_is
+        for patient_i in patient_is:
+            yield self.row(patient_i)
+
+    def to_pandas(self, patient_is=None, columns=None):
+        # DataFrame of the selected patients only (patient_is being positions), with the index and the columns of
+        # the original pickle, or the given columns only
+        table = self.patients if patient_is is None else self.patients.take(list(patient_is))
+        columns = columns if columns is not None else self.source_columns
+        return table.select(list(columns) + self.index_columns).to_pandas()
+
+def open_dataset(pickle_path, batch_size=64):
+    # Open the Arrow store next to a benchmark pickle, converting the pickle the first time and whenever it changed
+    store_dir = Path(pickle_path).with_suffix(".arrow")
+    if is_stale(store_dir, pickle_path):
+        with conversion_lock(store_dir):
+            # Another worker may have converted the pickle while this one waited for the lock
+            if is_stale(store_dir, pickle_path):
+                try:
+                    convert_pickle(pickle_path, store_dir, batch_size)
+                except OSError:
+                    # Without a lock, the rename fails when another worker installed its store first
+                    if is_stale(store_dir, pickle_path):
+                        raise
+    return DatasetStore(store_dir)
@@ -1,43 +1,6 @@
-import pandas as pd
-import vertexai
-from vertexai.preview.generative_models import GenerativeModel
-
-hashes = "#####################"
-next_note = "---NEXT NOTE---"
-note_header = "UNJITTERED NOTE DATE"
-
-def simplify_dates(text, note_type):
-    real_start = text.find(note_header) + len(note_header)
-    real_h_p = note_type + text[real_start:]
-    return real_h_p.replace(hashes, "").strip()
-
-def extract_h_p(text):
-    # Find the first occurrence of multiple #
-    start = text.find(hashes) + len(hashes)
-    # Find the second occurrence
-    end = text.find(hashes, start)
-    # Return the content between them, stripped of whitespace
-    full_h_p = text[start:end].strip()
-    return simplify_dates(full_h_p, "H&P").strip()
-
-def extract_last_progress_note(text):
-    # Remember that the last note is the first one to be found in the text
-    
-    # Find first hash occurrence
-    first_hash = text.find(hashes)
-    # Find second hash occurrence
-    start = text.find(hashes, first_hash + len(hashes)) + len(hashes)
-    # Find next note marker
-    end = text.find(next_note, start)
-    full_last_note = text[start:end].strip()    
-    return  simplify_dates(full_last_note, "LAST PROGRESS NOTE").strip()
-
-def extract_other_progress_notes(text):    
-    # Select all progress notes except the first that appears in the text (the last by date)
-    other_progress_notes = text.split("---NEXT NOTE---")[1:]
-    # reverse the list to get the first note (by date) first in the list
-    other_progress_notes = other_progress_notes[::-1]
-    return [simplify_dates(note, "PROGRESS NOTE NO " + str(i+1)) for i, note in enumerate(other_progress_notes)]
+from note_parser import parse_record
+# Moved to note_parser.py, still importable from here
+from note_parser import simplify_dates, extract_h_p, extract_last_progress_note, extract_other_progress_notes
 
 content = """1.  Reason for Admission: Clearly state the primary reason for the patient's hospitalization. 
 2.  Relevant Medical History: Briefly summarize significant pre-existing medical conditions.
@@ -61,6 +24,7 @@ Requirements:
 """
 
 def make_prompt_1(example_input):
+    record = parse_record(example_input)
     prompt = f"""
 You are an internal medicine specialist. Your task is to read the following first (History & Physical) and last progress note from a patient's hospital stay and to generate a concise, professional "Hospital Course Summary" for that patient.
 
@@ -68,10 +32,10 @@ Guidelines: Your Hospital Course Summary should include the following sections,
 {content_and_requirements}
 ---
 Patient History and Physical (H&P):
-{extract_h_p(example_input)}
+{record.h_p()}
 ---
 Patient last Progress Note:
-{extract_last_progress_note(example_input)}
+{record.last_progress_note()}
 ---
 Provide your "Hospital Course Summary" for the patient below following the guidelines and additional requirements.
 """
@@ -89,13 +53,14 @@ Your Draft "Hospital Course Summary":
 
 Extra Information from Other Progress Notes:
 ---
-{extract_other_progress_notes(example_input)[note_no]}
+{parse_record(example_input).progress_note(note_no)}
 ---
 Provide Your Improved "Hospital Course Summary" below:
 """
     return prompt
 
 def make_prompt_3(example_input, draft):
+    record = parse_record(example_input)
     prompt = f"""
 You are a specialized AI assistant trained in internal medicine, tasked with refining a Hospital Course Summary. Your goal is to ensure the summary is both comprehensive and strictly accurate, based only on the patient's medical records provided.
 
@@ -121,8 +86,8 @@ Input:
 
 - Entire sequence of notes for that patient: 
 ---
-{extract_h_p(example_input)}
-{"\n\n".join(extract_other_progress_notes(example_input))}
+{record.h_p()}
+{"\n\n".join(record.other_progress_notes())}
 ---
 
 Output:
@@ -139,7 +104,7 @@ def generate_summary(gen_model, example_input):
     drafts.append((0, previous_draft))
 
     # generate improved drafts by iteratively incorporating details from progress notes 1,2,3, ... not including the last note
-    no_of_notes = len(extract_other_progress_notes(example_input))
+    no_of_notes = parse_record(example_input).no_of_other_notes
     for i in range(no_of_notes):
         response = gen_model.generate_content([make_prompt_2(example_input, previous_draft, i)])
         previous_draft = response.candidates[0].content.parts[0].text
@@ -153,20 +118,25 @@ class DC_summarizer:
     def __init__(self, model_name="gemini-2.0-flash-exp"):
         # For HIPAA compliance, everything remains in our Google Cloud Project
         PROJECT_ID = 'som-nero-phi-jonc101'
+        # Imported on first use so that the prompt builders can be imported without the SDK
+        import vertexai
+        from vertexai.preview.generative_models import GenerativeModel
         self.model_instance = vertexai.init(project=PROJECT_ID)
         self.gen_model = GenerativeModel(model_name)
-        print(f"""A total of {2+len(extract_other_progress_notes(example_input))} notes need to be summarized for this patient.""")  
+        print(f"""A total of {parse_record(example_input).no_of_notes} notes need to be summarized for this patient.""")  
 
     def summarize(self, example_input):
         self.drafts, self.final_draft = generate_summary(self.gen_model, example_input)
     
 if __name__ == "__main__":    
-    # Load the trainset
-    trainset = pd.read_pickle('../../pickle/train_test_dfs/benchmark/trainset.pkl')
+    # Load the trainset (memory-mapped Arrow copy of the pickle, created on first use)
+    from dataset_store import open_dataset
+    trainset = open_dataset('../../pickle/train_test_dfs/benchmark/trainset.pkl')
     
     # Select an example input
     ex_i = 242
-    example_input = trainset["inputs"].iloc[ex_i]
+    example_row = trainset.row(ex_i)
+    example_input = example_row["inputs"]
     
     # Print the example input (physician's H&P and progress notes)
     print(example_input)
@@ -181,4 +151,4 @@ if __name__ == "__main__":
     print(DC_summary_example.final_draft)
     
     # Compare to the physician's summary
-    print(trainset["brief_hospital_course"].iloc[ex_i])
\ No newline at end of file
+    print(example_row["brief_hospital_course"])
\ No newline at end of file
@@ -0,0 +1,66 @@
+import re
+from note_parser import parse_record
+from prompt_budget import approx_token_count
+
+paragraph_break = re.compile(r"\n\s*\n")
+word = re.compile(r"\w+")
+omitted = "[... paragraphs copied from earlier notes omitted ...]"
+
+def normalize(paragraph):
+    # Copy-forwarded paragraphs often differ only by case, spacing or punctuation
+    return " ".join(word.findall(paragraph.lower()))
+
+def shingles(text, size=5):
+    words = word.findall(text.lower())
+    return {" ".join(words[i:i+size]) for i in range(max(1, len(words) - size + 1))}
+
+def dedup_notes(example_input, min_novelty=0.1, min_new_words=8, shingle_size=5):
+    # For progress notes 1,2,3, ... (the H&P and last note are already in the first draft), return the
+    # text to send to make_prompt_2, or None when the note is a near duplicate of what was already seen.
+    # A note is skipped when less than min_novelty of its word shingles are new or its new paragraphs hold fewer than
+    # min_new_words words; otherwise only its new paragraphs are kept
+    record = parse_record(example_input)
+    seen_paragraphs = set()
+    seen_shingles = set()
+    for note in (record.h_p(), record.last_progress_note()):
+        seen_paragraphs.update(normalize(p) for p in paragraph_break.split(note))
+        seen_shingles |= shingles(note, shingle_size)
+
+    plan = []
+    report = {"notes": record.no_of_other_notes, "skipped_notes": 0, "trimmed_notes": 0, "tokens_before": 0, "tokens_after": 0}
+    for note_no in range(record.no_of_other_notes):
+        note = record.progress_note(note_no)
+        n_tokens = approx_token_count(note)
+        report["tokens_before"] += n_tokens
+        note_shingles = shingles(note, shingle_size)
+        novelty = len(note_shingles - seen_shingles) / len(note_shingles)
+        seen_shingles |= note_shingles
+
+        # The first line holds the "PROGRESS NOTE NO i: date" header, always kept
+        header, _, body = note.partition("\n")
+        kept = []
+        for paragraph in paragraph_break.split(body):
+            key = normalize(paragraph)
+            if not key:
+                continue
+            if key in seen_paragraphs:
+                if not kept or kept[-1] != omitted:
+                    kept.append(omitted)
+            else:
+                seen_paragraphs.add(key)
+                kept.append(paragraph.strip())
+
+        new_words = sum(len(word.findall(paragraph)) for paragraph in kept if paragraph != omitted)
+        if novelty < min_novelty or new_words < min_new_words:
+            plan.append((note_no, None))
+            report["skipped_notes"] += 1
+            continue
+        new_note = "\n\n".join([header] + kept)
+        if omitted in kept:
+            report["trimmed_notes"] += 1
+        report["tokens_after"] += approx_token_count(new_note)
+        plan.append((note_no, new_note))
+
+    report["calls_avoided"] = report["skipped_notes"]
+    report["tokens_avoided"] = report["tokens_before"] - report["tokens_after"]
+    return plan, report
@@ -0,0 +1,126 @@
+import hashlib
+import re
+from datetime import datetime
+from functools import lru_cache
+
+hashes = "#####################"
+next_note = "---NEXT NOTE---"
+note_header = "UNJITTERED NOTE DATE"
+date_format = "%Y-%m-%d %H:%M:%S"
+# First line of each note once sliced out of the record (see simplify_dates), e.g. "PROGRESS NOTE NO 3: 2023-01-02 08:00:00"
+note_label = re.compile(r"^(?:H&P|LAST PROGRESS NOTE|PROGRESS NOTE NO \d+):", re.M)
+
+def simplify_dates(text, note_type):
+    real_start = text.find(note_header) + len(note_header)
+    real_h_p = note_type + text[real_start:]
+    return real_h_p.replace(hashes, "").strip()
+
+def parse_note_date(text, start=0, end=None):
+    # Read the "UNJITTERED NOTE DATE: YYYY-MM-DD HH:MM:SS" header of the note found in text[start:end]
+    end = len(text) if end is None else end
+    header = text.find(note_header, start, end)
+    if header == -1:
+        return None
+    date_start = header + len(note_header)
+    date_txt = text[date_start:min(date_start + 25, end)].lstrip(": ")[:19]
+    try:
+        return datetime.strptime(date_txt, date_format)
+    except ValueError:
+        return None
+
+class PatientRecord:
+    # Offsets of every note in an `inputs` text, found in a single scan of the markers.
+    # Notes are only sliced out of the text when a prompt needs them.
+    __slots__ = ("text", "h_p_span", "last_note_span", "note_spans", "h_p_date", "last_note_date", "note_dates")
+
+    def __init__(self, text):
+        self.text = text
+        hash_len = len(hashes)
+
+        # The H&P sits between the first two hash lines
+        first_hash = text.find(hashes)
+        h_p_start = first_hash + hash_len
+        h_p_end = text.find(hashes, h_p_start)
+        self.h_p_span = (h_p_start, h_p_end)
+
+        # Remember that the last note is the first one to be found in the text
+        markers = []
+        pos = text.find(next_note)
+        while pos != -1:
+            markers.append(pos)
+            pos = text.find(next_note, pos + len(next_note))
+        last_start = h_p_end + hash_len
+        last_end = text.find(next_note, last_start)
+        self.last_note_span = (last_start, last_end)
+
+        # Every other note runs from its marker to the next one; reverse to get the first note (by date) first
+        bounds = [m + len(next_note) for m in markers]
+        ends = markers[1:] + [len(text)]
+        self.note_spans = tuple(zip(bounds, ends))[::-1]
+
+        self.h_p_date = parse_note_date(text, *self._span_bounds(self.h_p_span))
+        self.last_note_date = parse_note_date(text, *self._span_bounds(self.last_note_span))
+        self.note_dates = tuple(parse_note_date(text, start, end) for start, end in self.note_spans)
+
+    def _span_bounds(self, span):
+        # Mirror str slicing so that an end of -1 drops the last character
+        start, end = span
+        return start, (len(self.text) + end if end < 0 else end)
+
+    def _slice(self, span):
+        start, end = span
+        return self.text[start:end]
+
+    @property
+    def no_of_other_notes(self):
+        return len(self.note_spans)
+
+    @property
+    def no_of_notes(self):
+        # H&P + last progress note + all other progress notes
+        return 2 + len(self.note_spans)
+
+    def h_p(self):
+        return simplify_dates(self._slice(self.h_p_span).strip(), "H&P").strip()
+
+    def last_progress_note(self):
+        return simplify_dates(self._slice(self.last_note_span).strip(), "LAST PROGRESS NOTE").strip()
+
+    def progress_note(self, note_no):
+        return simplify_dates(self._slice(self.note_spans[note_no]), "PROGRESS NOTE NO " + str(note_no+1))
+
+    def other_progress_notes(self):
+        return [self.progress_note(i) for i in range(len(self.note_spans))]
+
+    def fingerprint(self, note_no=None, which=None):
+        # Hash of a note's date and content, independent of its label (a last note becomes an other note when new notes arrive)
+        start, end = {"h_p": self.h_p_span, "last": self.last_note_span}[which] if which else self.note_spans[note_no]
+        # A last note without any other note runs to the end of the text
+        note = simplify_dates(self.text[start:len(self.text) if end == -1 else end].strip(), "")
+        return hashlib.sha1(note.encode("utf-8")).hexdigest()
+
+    def chronological_notes(self):
+        # (date, label, text) for the H&P, every other progress note and the last progress note, in order of writing
+        notes = [(self.h_p_date, "H&P", self.h_p())]
+        notes += [(date, f"PROGRESS NOTE NO {i+1}", self.progress_note(i)) for i, date in enumerate(self.note_dates)]
+        notes.append((self.last_note_date, "LAST PROGRESS NOTE", self.last_progress_note()))
+        return notes
+
+def split_notes(text):
+    # Notes of a text joined from several of them (e.g. the notes merged into one step by a NoteScheduler)
+    starts = [match.start() for match in note_label.finditer(text)]
+    starts = starts if starts and starts[0] == 0 else [0] + starts
+    return [text[start:end].strip() for start, end in zip(starts, starts[1:] + [len(text)]) if text[start:end].strip()]
+
+@lru_cache(maxsize=256)
+def parse_record(text):
+    return PatientRecord(text)
+
+def extract_h_p(text):
+    return parse_record(text).h_p()
+
+def extract_last_progress_note(text):
+    return parse_record(text).last_progress_note()
+
+def extract_other_progress_notes(text):
+    return parse_record(text).other_progress_notes()
@@ -0,0 +1,151 @@
+import heapq
+import math
+import re
+from collections import Counter, defaultdict
+from functools import lru_cache
+from note_parser import parse_record, split_notes
+from note_dedup import paragraph_break, word, omitted
+from note_scheduler import section_texts
+
+# What each of the nine sections of Format 1 looks for in the notes, used as retrieval queries
+section_queries = {
+    "reason for admission": "reason for admission chief complaint presenting presented admitted with",
+    "relevant medical history": "past medical history history of chronic known diagnosis baseline",
+    "relevant surgical history": "past surgical history surgery status post prior operation procedure",
+    "primary diagnosis": "diagnosis assessment impression consistent with likely secondary to",
+    "secondary diagnoses": "assessment and plan problem list secondary diagnoses complicated by",
+    "key diagnostic investigations and results": "labs results imaging ct mri x-ray echocardiogram ultrasound cultures biopsy showed revealed",
+    "therapeutic procedures performed": "procedure performed underwent placement intubation drainage catheter surgery transfusion",
+    "medications": "medications started increased decreased discontinued held dose mg daily iv po antibiotics",
+    "patient's condition at discharge": "condition at discharge stable improved ambulating tolerating diet discharge plan follow up",
+}
+stop_words = set("""a an and are as at be been but by for from had has have he her his in is it its of on or she that the
+                    their there this to was were which with pt patient""".split())
+sentence_end = re.compile(r"(?<=[.;!?])\s+|\n+")
+not_retrieved = "[... paragraphs not retrieved for this summary omitted ...]"
+
+def terms(text):
+    return [term for term in word.findall(text.lower()) if term not in stop_words]
+
+class ParagraphIndex:
+    # BM25 inverted index over the paragraphs of one patient's notes, in date order: H&P, progress notes, last note
+    def __init__(self, example_input, k1=1.5, b=0.75):
+        record = parse_record(example_input)
+        self.k1 = k1
+        self.b = b
+        # (header, paragraphs) of each note; the first line of a note is its label and date
+        self.notes = []
+        # (note_i, paragraph_i) of each paragraph id
+        self.paragraphs = []
+        self.lengths = []
+        postings = defaultdict(list)
+        for note_i, note in enumerate([record.h_p()] + record.other_progress_notes() + [record.last_progress_note()]):
+            header, _, body = note.partition("\n")
+            paragraphs = [paragraph.strip() for paragraph in paragraph_break.split(body) if paragraph.strip()]
+            self.notes.append((header, paragraphs))
+            for paragraph_i, paragraph in enumerate(paragraphs):
+                term_counts = Counter(terms(paragraph))
+                for term, tf in term_counts.items():
+                    postings[term].append((len(self.paragraphs), tf))
+                self.paragraphs.append((note_i, paragraph_i))
+                self.lengths.append(sum(term_counts.values()))
+        self.postings = dict(postings)
+        n = len(self.paragraphs)
+        self.avg_length = sum(self.lengths) / n if n else 1.0
+        self.idf = {term: math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5)) for term, docs in self.postings.items()}
+
+    def _weight(self, tf, length):
+        return tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / self.avg_length))
+
+    def search(self, query, k=3):
+        # Ids of the k paragraphs scoring highest for the query, best first
+        scores = defaultdict(float)
+        for term in set(terms(query)):
+            for paragraph_id, tf in self.postings.get(term, ()):
+                scores[paragraph_id] += self.idf[term] * self._weight(tf, self.lengths[paragraph_id])
+        return [paragraph_id for paragraph_id, _ in heapq.nlargest(k, scores.items(), key=lambda item: item[1])]
+
+    def rank_paragraphs(self, paragraphs, query, k=3):
+        # Positions of the k paragraphs of a text outside the index (e.g. a trimmed note) scoring highest for the query,
+        # with the statistics of the patient's notes
+        query_terms = set(terms(query))
+        scores = []
+        for position, paragraph in enumerate(paragraphs):
+            term_counts = Counter(terms(paragraph))
+            length = sum(term_counts.values())
+            score = sum(self.idf.get(term, 0.0) * self._weight(term_counts[term], length) for term in query_terms if term in term_counts)
+            if score > 0:
+                scores.append((score, position))
+        return [position for _, position in heapq.nlargest(k, scores)]
+
+    def excerpt(self, note_i, paragraph_ids):
+        # Header of a note and its selected paragraphs, in their order in the note
+        header, paragraphs = self.notes[note_i]
+        kept = sorted(paragraph_i for note_j, paragraph_i in (self.paragraphs[paragraph_id] for paragraph_id in paragraph_ids) if note_j == note_i)
+        lines = [header]
+        for position, paragraph_i in enumerate(kept):
+            if paragraph_i > (kept[position - 1] + 1 if position else 0):
+                lines.append(not_retrieved)
+            lines.append(paragraphs[paragraph_i])
+        if (kept[-1] if kept else -1) < len(paragraphs) - 1:
+            lines.append(not_retrieved)
+        return "\n\n".join(lines)
+
+@lru_cache(maxsize=256)
+def paragraph_index(example_input):
+    # Built once per patient, like parse_record
+    return ParagraphIndex(example_input)
+
+def draft_claims(draft, min_words=4):
+    # Sentences of the nine sections of a draft, the statements to verify
+    claims = []
+    for text in section_texts(draft).values():
+        claims += [sentence.strip(" :-*\t") for sentence in sentence_end.split(text) if len(word.findall(sentence)) >= min_words]
+    return claims
+
+class NoteRetriever:
+    # Replaces the full notes of the prompts by the paragraphs retrieved for them:
+    # - verification (make_prompt_3): the top k paragraphs for each section query and the top claim_k for each
+    #   sentence of the draft, from every note (H&P and last note headers are always kept)
+    # - refinement (make_prompt_2): the top note_k paragraphs of the note for each section query
+    def __init__(self, k=3, claim_k=2, note_k=2):
+        self.k = k
+        self.claim_k = claim_k
+        self.note_k = note_k
+
+    def evidence(self, example_input, draft, report=None):
+        # (h_p, progress_notes, last_note) excerpts to verify the draft against
+        index = paragraph_index(example_input)
+        claims = draft_claims(draft)
+        selected = set()
+        for query in section_queries.values():
+            selected.update(index.search(query, self.k))
+        for claim in claims:
+            selected.update(index.search(claim, self.claim_k))
+        last_i = len(index.notes) - 1
+        progress_notes = [index.excerpt(note_i, selected) for note_i in range(1, last_i) if any(index.paragraphs[p][0] == note_i for p in selected)]
+        if report is not None:
+            report["retrieval"] = {"paragraphs": len(index.paragraphs), "selected_paragraphs": len(selected),
+                                   "notes": len(index.notes), "notes_kept": len(progress_notes) + 2, "claims": len(claims)}
+        return index.excerpt(0, selected), progress_notes, index.excerpt(last_i, selected)
+
+    def note_excerpt(self, example_input, note):
+        # The paragraphs of a progress note relevant to any of the sections, header kept. The note may already
+        # be trimmed by dedup_notes: its markers are dropped, the gaps being marked as not retrieved.
+        # Notes merged into one text are excerpted one by one, each keeping its header
+        index = paragraph_index(example_input)
+        excerpts = []
+        for source_note in split_notes(note):
+            header, _, body = source_note.partition("\n")
+            paragraphs = [paragraph.strip() for paragraph in paragraph_break.split(body) if paragraph.strip() and paragraph.strip() != omitted]
+            kept = set()
+            for query in section_queries.values():
+                kept.update(index.rank_paragraphs(paragraphs, query, self.note_k))
+            lines = [header]
+            for position in range(len(paragraphs)):
+                if position in kept:
+                    lines.append(paragraphs[position])
+                elif lines[-1] != not_retrieved:
+                    lines.append(not_retrieved)
+            excerpts.append("\n\n".join(lines))
+        return "\n\n".join(excerpts)
@@ -0,0 +1,88 @@
+import re
+from difflib import SequenceMatcher
+from note_parser import parse_record
+from note_dedup import shingles, word
+
+# Sections of Format 1 in the summaries (see content in clinically_informed_workflow.py)
+section_names = ("Reason for Admission", "Relevant Medical History", "Relevant Surgical History", "Primary Diagnosis",
+                 "Secondary Diagnoses", "Key Diagnostic Investigations and Results", "Therapeutic Procedures Performed",
+                 "Medications", "Patient's Condition at Discharge")
+section_heading = re.compile("|".join(re.escape(name) for name in section_names), re.I)
+# Format 2 and the conclusion come after the nine sections
+section_end = re.compile(r"Format 2|Hospital Course/Significant Findings by Problem|Problem #1|Conclusion", re.I)
+
+def section_texts(draft):
+    # Text of each of the nine sections found in the draft, by lowercase section name ({} when the draft does not follow Format 1)
+    sections = {}
+    headings = list(section_heading.finditer(draft))
+    for i, heading in enumerate(headings):
+        name = heading.group().lower()
+        if name in sections:
+            continue
+        end = headings[i + 1].start() if i + 1 < len(headings) else len(draft)
+        stop = section_end.search(draft, heading.end(), end)
+        sections[name] = draft[heading.end():stop.start() if stop else end]
+    return sections
+
+def content_sections(draft):
+    # Word tokens of each of the nine sections found in the draft
+    return {name: word.findall(text.lower()) for name, text in section_texts(draft).items()}
+
+def draft_change(previous_draft, draft):
+    # Share of the section tokens that differ between two drafts: 1 - matching tokens / mean length, in [0, 1]
+    previous_sections, sections = content_sections(previous_draft), content_sections(draft)
+    if not previous_sections or not sections:
+        previous_sections, sections = {"": word.findall(previous_draft.lower())}, {"": word.findall(draft.lower())}
+    matched = 0
+    total = 0
+    for name in set(previous_sections) | set(sections):
+        a, b = previous_sections.get(name, []), sections.get(name, [])
+        matched += sum(block.size for block in SequenceMatcher(None, a, b, autojunk=False).get_matching_blocks())
+        total += len(a) + len(b)
+    return 1 - 2 * matched / total if total else 0.0
+
+class NoteScheduler:
+    # Adaptive refinement for the chain strategy (see generate_summary):
+    # - notes are refined most informative first, their predicted contribution being the number of word shingles
+    #   not in the H&P, the last note or the notes scheduled before them (greedy maximum coverage)
+    # - notes bringing fewer than min_new_words new shingles are skipped, notes where less than merge_below of the
+    #   shingles are new are sent together, merge_size at a time, after the others
+    # - the chain stops early once patience consecutive drafts changed by less than converge_below (see draft_change)
+    def __init__(self, min_new_words=8, merge_below=0.3, merge_size=3, converge_below=0.02, patience=2, shingle_size=5):
+        self.min_new_words = min_new_words
+        self.merge_below = merge_below
+        self.merge_size = merge_size
+        self.converge_below = converge_below
+        self.patience = patience
+        self.shingle_size = shingle_size
+
+    def plan(self, example_input, notes=None):
+        # Steps of the chain as lists of note numbers (one note, or several sent together) and the skipped notes.
+        # notes: {note_no: text} to use instead of the progress notes of the record (e.g. dedup_notes output)
+        record = parse_record(example_input)
+        if notes is None:
+            notes = {note_no: record.progress_note(note_no) for note_no in range(record.no_of_other_notes)}
+        covered = shingles(record.h_p(), self.shingle_size) | shingles(record.last_progress_note(), self.shingle_size)
+        note_shingles = {note_no: shingles(text, self.shingle_size) for note_no, text in notes.items()}
+        remaining = set(note_shingles)
+        singles, to_merge, skipped, gains = [], [], [], {}
+        while remaining:
+            # ties go to the earlier note
+            note_no = max(remaining, key=lambda i: (len(note_shingles[i] - covered), -i))
+            gain = len(note_shingles[note_no] - covered)
+            gains[note_no] = gain
+            covered |= note_shingles[note_no]
+            remaining.remove(note_no)
+            if gain < self.min_new_words:
+                skipped.append(note_no)
+            elif gain < self.merge_below * len(note_shingles[note_no]):
+                to_merge.append(note_no)
+            else:
+                singles.append([note_no])
+        to_merge.sort()
+        steps = singles + [to_merge[i:i + self.merge_size] for i in range(0, len(to_merge), self.merge_size)]
+        return steps, sorted(skipped), gains
+
+    def converged(self, changes):
+        # changes: draft_change of every refinement so far
+        return len(changes) >= self.patience and all(change < self.converge_below for change in changes[-self.patience:])
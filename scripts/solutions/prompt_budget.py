@@ -0,0 +1,139 @@
+import hashlib
+import os
+import re
+import tempfile
+from functools import lru_cache
+from note_parser import parse_record
+
+# Context windows (in tokens) of the models we use, the budget of a prompt is this minus the room kept for the answer
+model_context_tokens = {
+    "gemini-2.0-flash-exp": 1_048_576,
+    "gemini-1.5-pro": 2_097_152,
+    "gpt-4o": 128_000,
+    "claude-3-5-sonnet-v2": 200_000,
+    "llama-3-3-70B-instruct": 128_000,
+}
+
+word_or_symbol = re.compile(r"\w+|[^\w\s]")
+# Room kept for the answer by default, at most a quarter of a small max_tokens
+default_output_tokens = 8192
+tiktoken_encoding_url = "https://openaipublic.blob.core.windows.net/encodings/{}.tiktoken"
+
+def approx_token_count(text):
+    # Words and punctuation marks, usually within 10-20% of BPE tokenizers on clinical notes
+    return len(word_or_symbol.findall(text))
+
+def tiktoken_cached(encoding):
+    # Whether tiktoken has the file of an encoding in its local cache (same location as tiktoken.load.read_file_cached)
+    cache_dir = os.environ.get("TIKTOKEN_CACHE_DIR") or os.environ.get("DATA_GYM_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "data-gym-cache")
+    return os.path.exists(os.path.join(cache_dir, hashlib.sha1(tiktoken_encoding_url.format(encoding).encode()).hexdigest()))
+
+def tiktoken_counter(encoding="o200k_base", allow_download=False):
+    # Exact counts for OpenAI models, requires the optional tiktoken package. tiktoken downloads an encoding on its first
+    # use: unless allow_download, an encoding missing from its cache raises instead of being fetched in the middle of a run
+    import tiktoken
+    if not allow_download and not tiktoken_cached(encoding):
+        raise LookupError(f"tiktoken encoding {encoding!r} is not cached, fetch it once with tiktoken_counter({encoding!r}, allow_download=True)")
+    enc = tiktoken.get_encoding(encoding)
+    return lambda text: len(enc.encode(text, disallowed_special=()))
+
+@lru_cache(maxsize=None)
+def default_token_counter(allow_download=False):
+    # tiktoken when it is installed and its encoding is cached (or allow_download), the approximation otherwise,
+    # e.g. when the download fails
+    try:
+        return tiktoken_counter(allow_download=allow_download)
+    except Exception:
+        return approx_token_count
+
+class PromptTooLongError(ValueError):
+    pass
+
+class TokenBudget:
+    def __init__(self, model_name="gemini-2.0-flash-exp", max_tokens=None, reserve_output_tokens=None, count_tokens=None, safety_margin=None):
+        self.model_name = model_name
+        self.max_tokens = max_tokens if max_tokens is not None else model_context_tokens[model_name]
+        if reserve_output_tokens is None:
+            reserve_output_tokens = min(default_output_tokens, self.max_tokens // 4)
+        if reserve_output_tokens >= self.max_tokens:
+            raise ValueError(f"reserve_output_tokens ({reserve_output_tokens}) must be smaller than max_tokens ({self.max_tokens})")
+        self.reserve_output_tokens = reserve_output_tokens
+        self.count_tokens = count_tokens if count_tokens is not None else default_token_counter()
+        # Share of the prompt budget left unused for counting errors: the approximation undercounts BPE tokens on
+        # clinical abbreviations and doses, and tiktoken is only exact for OpenAI models
+        if safety_margin is None:
+            safety_margin = 0.25 if self.count_tokens is approx_token_count else 0.05
+        self.safety_margin = safety_margin
+
+    @property
+    def prompt_tokens(self):
+        return int((self.max_tokens - self.reserve_output_tokens) * (1 - self.safety_margin))
+
+    def check(self, prompt):
+        # Refuse a prompt before it is sent rather than after a slow failed round trip
+        n_tokens = self.count_tokens(prompt)
+        if n_tokens > self.prompt_tokens:
+            raise PromptTooLongError(f"Prompt has {n_tokens} tokens, the budget for {self.model_name} is {self.prompt_tokens} "
+                                     f"({self.safety_margin:.0%} safety margin)")
+        return n_tokens
+
+    def truncate(self, text, max_tokens):
+        # Keep the beginning of text within max_tokens
+        if max_tokens <= 0:
+            return ""
+        if self.count_tokens(text) <= max_tokens:
+            return text
+        matches = list(word_or_symbol.finditer(text))
+        # Scale the cut from the approximate count to the budget tokenizer, then shrink until it fits
+        cut = len(text) if len(matches) <= max_tokens else matches[max_tokens].start()
+        while cut > 0 and self.count_tokens(text[:cut]) > max_tokens:
+            cut = int(cut * 0.9)
+        return text[:cut]
+
+    def pack_h_p_last(self, example_input, fixed_tokens):
+        # H&P and last note in a prompt whose other parts use fixed_tokens: both whole if they fit, else the shorter one
+        # whole if it fits in half of the room left and the rest to the other, else half each (beginnings kept)
+        record = parse_record(example_input)
+        available = self.prompt_tokens - fixed_tokens
+        h_p, last_note = record.h_p(), record.last_progress_note()
+        h_p_tokens, last_tokens = self.count_tokens(h_p), self.count_tokens(last_note)
+        if h_p_tokens + last_tokens <= available:
+            return h_p, last_note
+        half = available // 2
+        if h_p_tokens <= half:
+            return h_p, self.truncate(last_note, available - h_p_tokens)
+        if last_tokens <= half:
+            return self.truncate(h_p, available - last_tokens), last_note
+        return self.truncate(h_p, half), self.truncate(last_note, available - half)
+
+    def pack_notes(self, example_input, fixed_tokens):
+        # Notes kept in a prompt whose other parts use fixed_tokens: H&P, last note, then the most recent notes first.
+        # Returns the H&P, the kept progress notes (in date order), the last note and the tokens of each section
+        record = parse_record(example_input)
+        return self.pack_texts(record.h_p(), record.other_progress_notes(), record.last_progress_note(), fixed_tokens)
+
+    def pack_texts(self, h_p, progress_notes, last_note, fixed_tokens):
+        # pack_notes for given texts, e.g. the excerpts of a NoteRetriever
+        available = self.prompt_tokens - fixed_tokens
+        report = {"fixed": fixed_tokens}
+
+        h_p = self.truncate(h_p, available)
+        report["h_p"] = self.count_tokens(h_p)
+        available -= report["h_p"]
+        last_note = self.truncate(last_note, available)
+        report["last_note"] = self.count_tokens(last_note)
+        available -= report["last_note"]
+
+        kept = {}
+        for note_no in reversed(range(len(progress_notes))):
+            note = progress_notes[note_no]
+            # +2 for the blank line joining the notes
+            n_tokens = self.count_tokens(note) + 2
+            if n_tokens <= available:
+                kept[note_no] = note
+                available -= n_tokens
+        report["progress_notes"] = self.prompt_tokens - fixed_tokens - report["h_p"] - report["last_note"] - available
+        report["notes_kept"] = len(kept)
+        report["notes_dropped"] = len(progress_notes) - len(kept)
+        report["total"] = self.prompt_tokens - available
+        return h_p, [kept[note_no] for note_no in sorted(kept)], last_note, report